@@ -1,27 +1,58 @@
-import json
+import logging
 import os
 import asyncio
+import copy
+import importlib
+import sys
+import time
 
 import azure.functions as func
+from shared_code.diagnostics import get_request_diagnostics, measure_async_stage, measure_stage, start_child_diagnostics, start_request_diagnostics
+from shared_code.serialization import encode_response
 
-from .aladdin_service import get_recommend_from_aladdin
-from .filter import filter_recommendation_result
-from .knowledge_base_service import get_recommend_from_knowledge_base
-from .offline_data_service import get_recommend_from_offline_data
-from .personalized_analysis import analyze_personal_path
-from .scenario_service import get_scenario_recommendation_from_search
-from .util import need_aladdin_recommendation, need_offline_recommendation, need_scenario_recommendation
+# The modules of the sources are imported when a request needs them, so the cold start only pays for the sources in use
+from .filter import filter_recommendation_result, is_filtered_item
+from .fusion import fuse_recommendation_items
+from .session import parse_command_list
+from .source_policy import SourceDecision, get_source_decisions
+from .util import RecommendationSource, need_aladdin_recommendation, need_offline_recommendation, need_scenario_recommendation
 
+# The fields of the recommended items used by the CLI, the other fields of the Cosmos documents are not returned
+COMMAND_SET_FIELDS = {'command': None, 'arguments': None, 'reason': None, 'example': None}
+RESPONSE_FIELDS = {
+    'command': None, 'arguments': None, 'reason': None, 'example': None, 'ratio': None, 'score': None, 'type': None,
+    'source': None, 'usage_condition': None, 'is_personalized': None,
+    'scenario': None, 'nextCommandSet': COMMAND_SET_FIELDS, 'executeIndex': None
+}
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+# Module name -> duration in ms of its first import by a request, reported as the cold start of the worker
+_import_durations = {}
+_is_first_request = True
+
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+
+    # Parameter `command_lists` is used to get the recommendations of multiple sessions in one request
+    try:
+        command_lists = get_param_list(req, 'command_lists')
+    except ValueError:
+        return func.HttpResponse('Illegal parameter: the parameter "command_lists" must be the list of string', status_code=400)
 
     try:
         command_list = get_param_str(req, 'command_list')
-        if not command_list:
+        if not command_list and not command_lists:
             return func.HttpResponse('Illegal parameter: please pass in the parameter "command_list"', status_code=400)
     except ValueError as e:
         return func.HttpResponse('Illegal parameter: the parameter "command_list" must be the type of string', status_code=400)
 
+    try:
+        if command_lists:
+            sessions = [parse_command_list(item) for item in command_lists]
+        else:
+            session = parse_command_list(command_list)
+    except ValueError:
+        return func.HttpResponse('Illegal parameter: the parameter "command_list" must be the JSON list of command items', status_code=400)
+
     # Parameter `top_num` is optional. If there is no `command_top_num` or `scenario_top_num`, the corresponding top_num will fall back to this value.
     try:
         top_num = get_param_int(req, 'top_num')
@@ -73,60 +104,230 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     except ValueError:
         return func.HttpResponse('Illegal parameter: the parameter "user_id" must be the type of string', status_code=400)
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    result = loop.run_until_complete(get_recommendation_items(command_list, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num, scenario_top_num))
+    # Parameters `correlation_ids` and `user_ids` are optional in batch mode, one value per session of `command_lists`
+    if command_lists:
+        try:
+            correlation_ids = get_param_list(req, 'correlation_ids')
+            if correlation_ids is None:
+                # The sessions get their own correlation ids so their calls to Aladdin can be told apart
+                correlation_ids = ['{}-{}'.format(correlation_id, index) if correlation_id else None for index in range(len(sessions))]
+            user_ids = get_param_list(req, 'user_ids') or [user_id] * len(sessions)
+            if len(correlation_ids) != len(sessions) or len(user_ids) != len(sessions):
+                raise ValueError('The parameters must have one value per session')
+        except ValueError:
+            return func.HttpResponse('Illegal parameter: the parameters "correlation_ids" and "user_ids" must be the list of string with one value per item of "command_lists"', status_code=400)
+
+    diagnostics = start_request_diagnostics('RecommendationService')
+    diagnostics.set_property('type', recommend_type)
+    if command_lists:
+        results, skipped_sources, session_errors = await get_batch_recommendation(sessions, recommend_type, error_info, correlation_ids, subscription_id, cli_version, user_ids, command_top_num, scenario_top_num)
+        diagnostics.set_property('batch_size', len(sessions))
+        diagnostics.set_property('session_errors', len(session_errors))
+        response_data = generate_response(data=results, status=200, skipped_sources=skipped_sources, session_errors=session_errors)
+    else:
+        result, skipped_sources = await get_recommendation(session, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num, scenario_top_num)
+        diagnostics.set_property('items', len(result or []))
+        if not result and not skipped_sources:
+            response_data = {}
+        else:
+            response_data = generate_response(data=result, status=200, skipped_sources=skipped_sources)
+
+    with measure_stage('serialize'):
+        body, mimetype, headers = encode_response(req, response_data, RESPONSE_FIELDS)
+    diagnostics.set_property('response_bytes', len(body))
+    diagnostics.set_property('skipped_sources', skipped_sources)
+    global _is_first_request
+    if _is_first_request:
+        # The first request in the worker pays for the imports of the sources and the lazy initialization of their clients
+        _is_first_request = False
+        diagnostics.set_property('cold_start', {'first_request_ms': round(diagnostics.get_total_duration() * 1000, 2),
+                                                'imports_ms': dict(_import_durations)})
+    diagnostics.log()
+    headers.update(diagnostics.get_headers())
+    return func.HttpResponse(body, status_code=200, mimetype=mimetype, headers=headers)
+
+
+async def get_recommendation(session, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num=5, scenario_top_num=5, shared_items=None):
+    result, skipped_sources = await get_recommendation_items(session, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num, scenario_top_num, shared_items)
 
     if os.environ["Support_Personalization"] == '1':
-        result = analyze_personal_path(result, command_list)
-
-    result = filter_recommendation_result(result, command_list, command_top_num, scenario_top_num)
-
-    if not result:
-        return func.HttpResponse('{}', status_code=200)
-
-    return func.HttpResponse(generate_response(data=result, status=200))
-
-
-async def get_recommendation_items(command_list, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num=5, scenario_top_num=5):
-    loop = asyncio.get_event_loop()
+        personalized_analysis = _import_source_module('personalized_analysis')
+        with measure_stage('personalization'):
+            result = personalized_analysis.analyze_personal_path(result, session, user_id)
+
+    with measure_stage('filter'):
+        result = filter_recommendation_result(result, session, command_top_num, scenario_top_num)
+
+    return result, skipped_sources
+
+
+async def get_batch_recommendation(sessions, recommend_type, error_info, correlation_ids, subscription_id, cli_version, user_ids, command_top_num=5, scenario_top_num=5):
+    '''Get the recommendations of multiple sessions, one result per session
+
+    The sessions with the same last two commands are grouped, the knowledge base and the offline data are loaded once per group
+    and shared by the sessions of the group. Each session records its own diagnostics, and a failed session gets an error
+    in `session_errors` instead of failing the batch.
+
+    Returns:
+        tuple: (results with None for the failed sessions, skipped sources, session index -> error message)
+    '''
+    semaphore = asyncio.Semaphore(int(os.environ.get("Batch_Concurrency", "32")))
+    diagnostics = get_request_diagnostics()
+    # Group key -> {RecommendationSource: future of the items shared by the sessions of the group}
+    groups = {get_session_group_key(session, recommend_type): {} for session in sessions}
+
+    async def _get_recommendation(index, session):
+        async with semaphore:
+            session_diagnostics = start_child_diagnostics()
+            try:
+                return await get_recommendation(session, recommend_type, error_info, correlation_ids[index], subscription_id, cli_version, user_ids[index], command_top_num, scenario_top_num,
+                                                shared_items=groups[get_session_group_key(session, recommend_type)])
+            finally:
+                if session_diagnostics is not None:
+                    diagnostics.merge(session_diagnostics)
+
+    batch_result = await asyncio.gather(*[_get_recommendation(index, session) for index, session in enumerate(sessions)], return_exceptions=True)
+
+    results = []
+    skipped_sources = set()
+    session_errors = {}
+    for index, session_result in enumerate(batch_result):
+        if isinstance(session_result, BaseException):
+            logging.warning('Failed to get the recommendation of session {} in the batch: {}'.format(index, repr(session_result)))
+            results.append(None)
+            session_errors[str(index)] = 'Failed to get the recommendation of the session'
+            continue
+        result, skipped = session_result
+        results.append(result or [])
+        skipped_sources.update(skipped)
+    return results, sorted(skipped_sources), session_errors
+
+
+def get_session_group_key(session, recommend_type):
+    '''The knowledge base and the offline data only depend on the last two commands when the type and the error are the same'''
+    return tuple(session.latest_commands(2)), recommend_type
+
+
+async def get_recommendation_items(session, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num=5, scenario_top_num=5, shared_items=None):
+    # The sources with negligible adoption for the last command are skipped or run in the background
+    source_decisions = get_source_decisions(session)
+    if source_decisions:
+        diagnostics = get_request_diagnostics()
+        if diagnostics is not None:
+            diagnostics.set_property('source_decisions', {int(source): decision.value for source, decision in source_decisions.items()})
+
+    RequestChargeCeilingExceeded = _import_source_module('cosmos_helper').RequestChargeCeilingExceeded
+
+    async def _get_shared_items(source, load):
+        # The sessions of a batch group load the source once, each of them gets a copy since the items are modified later
+        if shared_items is None:
+            return await load()
+        future = shared_items.get(source)
+        if future is None:
+            future = shared_items[source] = asyncio.ensure_future(load())
+            return copy.deepcopy(await asyncio.shield(future))
+        try:
+            return copy.deepcopy(await asyncio.shield(future))
+        except RequestChargeCeilingExceeded:
+            # The request charge is counted per session, the session which started the load may have used up its own
+            return await load()
 
     # Take the data of knowledge base first, when the quantity of knowledge base is not enough, then take the data from calculation and Aladdin
-    knowledge_base_items_future = loop.run_in_executor(None, get_recommend_from_knowledge_base, command_list, recommend_type, error_info)
+    async def _get_knowledge_base_recommendation(session, recommend_type, error_info):
+        knowledge_base_service = _import_source_module('knowledge_base_service')
+        return await _get_shared_items(RecommendationSource.KnowledgeBase, lambda: knowledge_base_service.get_recommend_from_knowledge_base(session, recommend_type, error_info))
+    knowledge_base_items_future = asyncio.ensure_future(measure_async_stage('knowledge_base', _get_knowledge_base_recommendation(session, recommend_type, error_info)))
 
     # Get the recommendation of offline caculation from offline data
-    async def _get_offline_recommendation(command_list, recommend_type, error_info, command_top_num):
+    async def _get_offline_recommendation(session, recommend_type, error_info, command_top_num):
         offline_items = []
-        if need_offline_recommendation(recommend_type, error_info=None):
-            offline_items = await get_recommend_from_offline_data(command_list, recommend_type, error_info=None, top_num=command_top_num)
+        if need_offline_recommendation(recommend_type, error_info=None) and source_decisions.get(RecommendationSource.OfflineCaculation) != SourceDecision.Skip:
+            offline_data_service = _import_source_module('offline_data_service')
+            offline_items = await _get_shared_items(RecommendationSource.OfflineCaculation,
+                                                    lambda: offline_data_service.get_recommend_from_offline_data(session, recommend_type, error_info=None, top_num=command_top_num))
         return offline_items
-    calculation_items_future = _get_offline_recommendation(command_list, recommend_type, error_info, command_top_num)
+    calculation_items_future = asyncio.ensure_future(measure_async_stage('offline', _get_offline_recommendation(session, recommend_type, error_info, command_top_num)))
 
     # Get the recommendation from Aladdin
-    def _get_aladdin_recommendation(command_list, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num):
+    async def _get_aladdin_recommendation(session, recommend_type, error_info, correlation_id, subscription_id, cli_version, user_id, command_top_num):
         aladdin_items = []
-        if need_aladdin_recommendation(recommend_type, error_info=None):
-            aladdin_items = get_recommend_from_aladdin(command_list, correlation_id, subscription_id, cli_version, user_id, command_top_num)
+        if need_aladdin_recommendation(recommend_type, error_info=None) and source_decisions.get(RecommendationSource.Aladdin) != SourceDecision.Skip:
+            aladdin_items = await _import_source_module('aladdin_service').get_recommend_from_aladdin(session, correlation_id, subscription_id, cli_version, user_id, command_top_num)
         return aladdin_items
-    aladdin_items_future = loop.run_in_executor(None, _get_aladdin_recommendation, command_list, recommend_type, None, correlation_id, subscription_id, cli_version, user_id, command_top_num)
+    aladdin_items_future = asyncio.ensure_future(measure_async_stage('aladdin', _get_aladdin_recommendation(session, recommend_type, None, correlation_id, subscription_id, cli_version, user_id, command_top_num)))
 
-    def _get_scenario_recommendation(command_list, recommend_type, scenario_top_num):
+    async def _get_scenario_recommendation(session, recommend_type, scenario_top_num):
         scenario_items = []
-        if need_scenario_recommendation(recommend_type, error_info=None):
-            scenario_items = get_scenario_recommendation_from_search(command_list, scenario_top_num)
+        if need_scenario_recommendation(recommend_type, error_info=None) and source_decisions.get(RecommendationSource.Search) != SourceDecision.Skip:
+            scenario_items = await _import_source_module('scenario_service').get_scenario_recommendation_from_search(session, scenario_top_num)
         return scenario_items
-    scenario_items_future = loop.run_in_executor(None, _get_scenario_recommendation, command_list, recommend_type, scenario_top_num)
-
-    calculation_items = await calculation_items_future
-    knowledge_base_items = await knowledge_base_items_future
-    aladdin_items = await aladdin_items_future
-    scenario_items = await scenario_items_future
+    scenario_items_future = asyncio.ensure_future(measure_async_stage('search', _get_scenario_recommendation(session, recommend_type, scenario_top_num)))
 
-    result = merge_and_sort_recommendation_items(knowledge_base_items, calculation_items, aladdin_items)
-    result.extend(scenario_items)
-
-    return result
+    source_futures = {
+        RecommendationSource.KnowledgeBase: knowledge_base_items_future,
+        RecommendationSource.OfflineCaculation: calculation_items_future,
+        RecommendationSource.Aladdin: aladdin_items_future,
+        RecommendationSource.Search: scenario_items_future
+    }
+    # The background sources are not waited for, their items are used only when they have finished by then
+    background_futures = {future for source, future in source_futures.items() if source_decisions.get(source) == SourceDecision.Background}
+    for future in background_futures:
+        future.add_done_callback(_ignore_background_result)
+
+    # When the latency budget runs out, the sources that have not finished are cancelled and skipped
+    latency_budget = int(os.environ.get("Recommendation_Latency_Budget", "0"))
+    foreground_futures = [future for future in source_futures.values() if future not in background_futures]
+    _, pending = await asyncio.wait(foreground_futures, timeout=latency_budget / 1000 if latency_budget > 0 else None)
+    for future in pending:
+        future.cancel()
+
+    skipped_sources = [source for source, future in source_futures.items() if future in pending]
+    # The unfinished or failed background sources are left out of the result without being skipped
+    pending.update(future for future in background_futures if not future.done() or future.cancelled() or future.exception() is not None)
+    if skipped_sources:
+        logging.info('Skipped recommendation sources exceeding the latency budget of {}ms: {}'.format(latency_budget, [int(source) for source in skipped_sources]))
+
+    # The sources whose Cosmos queries are skipped by `Cosmos_Request_RU_Ceiling` are skipped as well
+    exceeded_sources = [source for source, future in source_futures.items()
+                        if future not in pending and isinstance(future.exception(), RequestChargeCeilingExceeded)]
+    if exceeded_sources:
+        logging.info('Skipped recommendation sources exceeding the request charge ceiling: {}'.format([int(source) for source in exceeded_sources]))
+        skipped_sources.extend(exceeded_sources)
+
+    exceeded_futures = {source_futures[source] for source in exceeded_sources}
+
+    def _get_items(future):
+        return [] if future in pending or future in exceeded_futures else future.result()
+
+    with measure_stage('merge'):
+        # The items dropped by the filter are removed before the merge, so the merge only needs to keep the top commands.
+        # The personalization may promote any merged command, so all of them are kept when it is enabled.
+        fusion_top_num = None if os.environ["Support_Personalization"] == '1' else command_top_num
+        result = fuse_recommendation_items({
+            source: [item for item in _get_items(future) if not is_filtered_item(item, session)]
+            for source, future in [(RecommendationSource.KnowledgeBase, knowledge_base_items_future),
+                                   (RecommendationSource.OfflineCaculation, calculation_items_future),
+                                   (RecommendationSource.Aladdin, aladdin_items_future)]
+        }, top_num=fusion_top_num)
+        result.extend(_get_items(scenario_items_future))
+
+    return result, skipped_sources
+
+
+def _import_source_module(name):
+    '''Import a module of the package when a request first needs it, the duration of the import is recorded for the cold start'''
+    module = sys.modules.get(__name__ + '.' + name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module('.' + name, __name__)
+        _import_durations[name] = round((time.perf_counter() - start) * 1000, 2)
+    return module
+
+
+def _ignore_background_result(future):
+    # Retrieve the exception of a background source so it is not reported as never retrieved
+    if not future.cancelled() and future.exception() is not None:
+        logging.info('Background recommendation source failed: {}'.format(repr(future.exception())))
 
 
 def get_param_str(req, param_name):
@@ -143,6 +344,14 @@ def get_param_str(req, param_name):
     return param
 
 
+def get_param_list(req, param_name):
+    param = get_param_str(req, param_name)
+    if param is not None:
+        if not isinstance(param, list) or not all(isinstance(item, str) for item in param):
+            raise ValueError('The parameter {} must be the list of string'.format(param_name))
+    return param
+
+
 def get_param_int(req, param_name):
     param = get_param_str(req, param_name)
     if param:
@@ -153,68 +362,14 @@ def get_param_int(req, param_name):
     return param
 
 
-def generate_response(data, status, error=None):
+def generate_response(data, status, error=None, skipped_sources=None, session_errors=None):
     response_data = {
         'data': data,
         'error': error,
         'status': status
     }
-    return json.dumps(response_data)
-
-
-# Merge and sort multiple data sources
-def merge_and_sort_recommendation_items(knowledge_base_items, calculation_items, aladdin_items):
-
-    result = knowledge_base_items
-
-    # Record recommended commands for duplicate removal
-    exist_commands = []
-    if knowledge_base_items:
-        for item in knowledge_base_items:
-            if 'command' in item:
-                exist_commands.append(item['command'])
-
-    # Merge calculation_items and aladdin_items, and sort them interleaved
-    command_index = 0
-    commands_from_recommendation = []
-    while(command_index < len(calculation_items) and command_index < len(aladdin_items)):
-        aladdin_command = aladdin_items[command_index]['command']
-        calculation_command = calculation_items[command_index]['command']
-
-        if os.environ["Recommendation_Prefer"] == "1":
-            if calculation_command not in exist_commands:
-                commands_from_recommendation.append(calculation_items[command_index])
-                exist_commands.append(calculation_command)
-            if aladdin_command not in exist_commands:
-                commands_from_recommendation.append(aladdin_items[command_index])
-                exist_commands.append(aladdin_command)
-
-        else:
-            if aladdin_command not in exist_commands:
-                commands_from_recommendation.append(aladdin_items[command_index])
-                exist_commands.append(aladdin_command)
-            if calculation_command not in exist_commands:
-                commands_from_recommendation.append(calculation_items[command_index])
-                exist_commands.append(calculation_command)
-
-        command_index = command_index + 1
-
-    commands_from_recommendation = merge_remaining_items(command_index, calculation_items, exist_commands, commands_from_recommendation)
-    commands_from_recommendation = merge_remaining_items(command_index, aladdin_items, exist_commands, commands_from_recommendation)
-
-    result.extend(commands_from_recommendation)
-    return result
-
-
-def merge_remaining_items(command_index, items, exist_commands, commands_from_recommendation):
-
-    while command_index < len(items):
-
-        command = items[command_index]['command']
-        if command not in exist_commands:
-            commands_from_recommendation.append(items[command_index])
-            exist_commands.append(command)
-
-        command_index = command_index + 1
-
-    return commands_from_recommendation
+    if skipped_sources:
+        response_data['skipped_sources'] = skipped_sources
+    if session_errors:
+        response_data['session_errors'] = session_errors
+    return response_data
@@ -1,14 +1,159 @@
+import asyncio
 import os
-import requests
 import json
 import logging
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+import aiohttp
+from shared_code.serialization import loads
+
 from .util import RecommendationSource, RecommendType
 
 
-def get_recommend_from_aladdin(command_list, correlation_id, subscription_id, cli_version, user_id, top_num=50):  # pylint: disable=unused-argument
-    '''query next command from web api'''
+class AladdinClient:
+    '''Pooled async HTTP client of Aladdin with timeouts and optional hedged requests'''
+
+    def __init__(self, url, connect_timeout=1.0, read_timeout=2.0, pool_size=100, keepalive_timeout=60,
+                 hedge_percentile=0, hedge_min_samples=20):
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        # Send a second request when the first one is slower than this percentile of recent latencies, 0 means disabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.metrics = {'requests': 0, 'errors': 0, 'timeouts': 0, 'hedged': 0}
+        self._latencies = deque(maxlen=500)
+        self._session = None
+        self._loop = None
+        # Keep the tasks closing the replaced sessions referenced until they are done
+        self._closing_tasks = set()
+
+    def _get_session(self):
+        # The session is bound to the event loop it was created in, which is the loop of the Functions host
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._release_session()
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    def _release_session(self):
+        '''Close the session being replaced, so its connector is not left open until it is collected'''
+        session, loop = self._session, self._loop
+        self._session = None
+        if session is None or session.closed:
+            return
+        if loop is not None and loop.is_running():
+            # The loop of the session is running in another thread, the session is closed there
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        elif loop is None or loop.is_closed():
+            # The connector does not wait for the connections of a closed loop, so it can be closed from the new loop
+            task = asyncio.ensure_future(session.close())
+            self._closing_tasks.add(task)
+            task.add_done_callback(self._closing_tasks.discard)
+        else:
+            # The connections of a stopped loop can only be closed by that loop, the session is detached from them
+            session.detach()
+
+    async def open_connection(self):
+        '''Open a pooled connection to Aladdin before the first request, a HEAD request completes the TCP and TLS handshakes'''
+        async with self._get_session().head(self.url) as response:
+            return response.status
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def get_hedge_delay(self):
+        if not self.hedge_percentile or len(self._latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+        return latencies[index]
+
+    async def _post(self, data, headers):
+        async with self._get_session().post(self.url, data=data, headers=headers) as response:
+            return response.status, response.reason, await response.text()
+
+    async def _post_hedged(self, data, headers, hedge_delay):
+        first = asyncio.ensure_future(self._post(data, headers))
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        self.metrics['hedged'] += 1
+        pending = {first, asyncio.ensure_future(self._post(data, headers))}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Fall back to the other request when the finished one failed, both may finish at the same time
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                if not pending:
+                    # Every request failed
+                    return done.pop().result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def post(self, data, headers):
+        self.metrics['requests'] += 1
+        hedge_delay = self.get_hedge_delay()
+        hedged_count = self.metrics['hedged']
+        start = time.perf_counter()
+        status = None
+        try:
+            if hedge_delay is None:
+                status, reason, text = await self._post(data, headers)
+            else:
+                status, reason, text = await self._post_hedged(data, headers, hedge_delay)
+        except asyncio.TimeoutError:
+            self.metrics['timeouts'] += 1
+            raise
+        except aiohttp.ClientError:
+            self.metrics['errors'] += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            if status is not None:
+                self._latencies.append(latency)
+            logging.info('AladdinMetrics: %s', json.dumps({
+                'latency_ms': round(latency * 1000, 2),
+                'status': status,
+                'hedged': self.metrics['hedged'] > hedged_count,
+                **self.metrics
+            }))
+        if status != 200:
+            self.metrics['errors'] += 1
+        return status, reason, text
+
+
+_aladdin_client = None
+_aladdin_client_lock = threading.Lock()
 
-    url = os.environ["Aladdin_Service_URL"]
+
+def get_aladdin_client():
+    '''Lazily create the client shared by all requests in the worker'''
+    global _aladdin_client
+    if _aladdin_client is None:
+        with _aladdin_client_lock:
+            if _aladdin_client is None:
+                _aladdin_client = AladdinClient(os.environ["Aladdin_Service_URL"],
+                                                connect_timeout=float(os.environ.get("Aladdin_Connect_Timeout", "1")),
+                                                read_timeout=float(os.environ.get("Aladdin_Read_Timeout", "2")),
+                                                pool_size=int(os.environ.get("Aladdin_Pool_Size", "100")),
+                                                hedge_percentile=float(os.environ.get("Aladdin_Hedge_Percentile", "0")))
+    return _aladdin_client
+
+
+async def get_recommend_from_aladdin(session, correlation_id, subscription_id, cli_version, user_id, top_num=50):  # pylint: disable=unused-argument
+    '''query next command from web api'''
 
     headers = {
         'Content-Type': 'application/json'
@@ -17,7 +162,7 @@ def get_recommend_from_aladdin(command_list, correlation_id, subscription_id, cl
         headers["X-UserId"] = user_id
 
     payload = {
-        "history": get_cmd_history(command_list),
+        "history": get_cmd_history(session),
         "clientType": "AzureCli",
         "context": {
             "versionNumber": cli_version    
@@ -30,76 +175,38 @@ def get_recommend_from_aladdin(command_list, correlation_id, subscription_id, cl
     if subscription_id:
         payload["context"]["SubscriptionId"] = subscription_id
 
-    response = requests.post(url, json.dumps(payload), headers=headers)
-    if response.status_code != 200:
-        logging.info('Status:{} {} ErrorMessage:{}'.format(response.status_code, response.reason, response.text))
+    try:
+        status, reason, text = await get_aladdin_client().post(json.dumps(payload), headers)
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logging.info('Aladdin request failed: {}'.format(repr(e)))
         return []
-    return transform_response(response)
+    if status != 200:
+        logging.info('Status:{} {} ErrorMessage:{}'.format(status, reason, text))
+        return []
+    return transform_response(text)
 
 
-def get_cmd_history(command_list):
-    command_data = json.loads(command_list)
-    if len(command_data) == 0:
+def get_cmd_history(session):
+    aladdin_commands = session.aladdin_commands
+    if len(aladdin_commands) == 0:
         return ["start_of_snippet", "start_of_snippet"]
-    if len(command_data) == 1 or os.environ["Aladdin_History_Command"] == "1":
-        return ["start_of_snippet", get_cmd_data(command_data[-1])]
-    return [get_cmd_data(command_data[-2]), get_cmd_data(command_data[-1])] 
-
+    if len(aladdin_commands) == 1 or os.environ["Aladdin_History_Command"] == "1":
+        return ["start_of_snippet", aladdin_commands[-1]]
+    return [aladdin_commands[-2], aladdin_commands[-1]]
 
-def get_cmd_data(command_item):
-    command_item = json.loads(command_item)
-    command_data = command_item['command']
-    if 'arguments' in command_item:
-        # parameters in the model is already sorted in alphabetical order, so the parameters we pass in should also keep this rule
-        command_item['arguments'] = sorted(command_item['arguments'])
-        command_data = '{} {}'.format(command_data, ' *** '.join(command_item['arguments']) + ' ***')
-    return command_data
 
-
-def transform_response(response):
-    response_data = json.loads(response.text)
+def transform_response(response_text):
+    response_data = loads(response_text)
     result = []
 
     for recommended_item in response_data: 
         if 'command' not in recommended_item or not recommended_item['command']:
             continue
 
-        cmd_items = recommended_item['command'].split()
-
-        sub_commands = []
-        arguments = []
-        argument_start = False
-        argument_values = {}
-        values = []
-        for item in cmd_items:
-            if item.startswith('-'):
-                argument_start = True
-                # In the case of "positional arguments" and "no arguments", the value of item is '-' 
-                if item != '-':
-                    if values and arguments:
-                        argument_values[arguments[-1]] = values
-                        values = []
-                    arguments.append(item)
-            elif not argument_start and not item.startswith('<'):
-                sub_commands.append(item)
-            else:
-                values.append(item)
-        if values and arguments:
-            argument_values[arguments[-1]] = values
-
-        example = ' '.join(sub_commands)
-        for argument in arguments:
-            example = example + ' ' + argument
-            if argument in argument_values and argument_values[argument]:
-                arg_values = ' '.join(argument_values[argument])
-                if arg_values.startswith('<'):
-                    example = example + ' ' + arg_values
-                else:
-                    example = example + ' <' +  arg_values + '>'
-
+        command, arguments, example = parse_command(recommended_item['command'])
         command_info = {
-            "command": " ".join(sub_commands),
-            "arguments": arguments,
+            "command": command,
+            "arguments": list(arguments),
             "source": RecommendationSource.Aladdin,
             "type": RecommendType.Command,
             "example": example
@@ -112,3 +219,46 @@ def transform_response(response):
         result.append(command_info)
 
     return result
+
+
+@lru_cache(maxsize=int(os.environ.get("Aladdin_Parse_Cache_Size", "4096")))
+def parse_command(raw_command):
+    '''Split the predicted command into (command, arguments, example)
+
+    Aladdin predicts from a small set of command templates, so the parsed results are memoized.
+    The arguments are returned as a tuple because the cached result is shared.
+    '''
+    cmd_items = raw_command.split()
+
+    sub_commands = []
+    arguments = []
+    argument_start = False
+    argument_values = {}
+    values = []
+    for item in cmd_items:
+        if item.startswith('-'):
+            argument_start = True
+            # In the case of "positional arguments" and "no arguments", the value of item is '-' 
+            if item != '-':
+                if values and arguments:
+                    argument_values[arguments[-1]] = values
+                    values = []
+                arguments.append(item)
+        elif not argument_start and not item.startswith('<'):
+            sub_commands.append(item)
+        else:
+            values.append(item)
+    if values and arguments:
+        argument_values[arguments[-1]] = values
+
+    example = ' '.join(sub_commands)
+    for argument in arguments:
+        example = example + ' ' + argument
+        if argument in argument_values and argument_values[argument]:
+            arg_values = ' '.join(argument_values[argument])
+            if arg_values.startswith('<'):
+                example = example + ' ' + arg_values
+            else:
+                example = example + ' <' +  arg_values + '>'
+
+    return " ".join(sub_commands), tuple(arguments), example
@@ -1,41 +1,163 @@
+import asyncio
+import copy
 import os
+import threading
 
-from azure.cosmos import CosmosClient
+from shared_code.cache import TTLCache, is_revalidating
+from shared_code.diagnostics import get_request_diagnostics
 
-from .util import generated_query_kql
+from .cosmos_metrics import cosmos_metrics, record_cosmos_operation
+from .util import generated_cosmos_type, generated_query_kql, generated_signature_query_kql, get_error_signature
 
-client = CosmosClient(os.environ["CosmosDB_Endpoint"], os.environ["CosmosDB_Key"])
-database = client.get_database_client(os.environ["CosmosDB_DataBase"])
-knowledge_base_container = database.get_container_client(os.environ["KnowledgeBase_Container"])
-recommendation_container = database.get_container_client(os.environ["Recommendation_Container"])
-recommendation_container_2 = database.get_container_client(os.environ["Recommendation_Container_2"])
-e2e_scenario_container = database.get_container_client(os.environ["E2EScenario_Container"])
+# The client and the container clients are created on first use, so the cold start does not import the Cosmos SDK
+# before the first request which needs it
+_database = None
+_containers = {}
+_client_lock = threading.Lock()
 
 
-def query_recommendation_from_knowledge_base(prev_command, recommend_type, error_info):
-    query = generated_query_kql(prev_command, recommend_type, error_info)
+def get_container(container_setting):
+    '''Get the container client of the container named by the app setting, e.g. `KnowledgeBase_Container`'''
+    container = _containers.get(container_setting)
+    if container is None:
+        global _database
+        with _client_lock:
+            if _database is None:
+                from azure.cosmos.aio import CosmosClient
+                client = CosmosClient(os.environ["CosmosDB_Endpoint"], os.environ["CosmosDB_Key"])
+                _database = client.get_database_client(os.environ["CosmosDB_DataBase"])
+            if container_setting not in _containers:
+                _containers[container_setting] = _database.get_container_client(os.environ[container_setting])
+            container = _containers[container_setting]
+    return container
 
-    return knowledge_base_container.query_items(query=query, enable_cross_partition_query=True)
+# With `Cosmos_Request_RU_Ceiling`, the queries of the sources whose priority is at least `Cosmos_RU_Ceiling_Skip_Priority`
+# are skipped once the request (each session of a batch request) has used the ceiling, the knowledge base query is never
+# skipped. The concurrent queries of the sources start before any of them is charged, so each follow-up query, e.g. the
+# `CONTAINS` fallback of the error signature lookup, is checked again against the running charge.
+QUERY_PRIORITY = {
+    'knowledge_base': 0,
+    # The `CONTAINS` fallback scans the error information of all solutions, so it can be skipped like the offline data
+    ('knowledge_base', 'fallback_query'): 1,
+    'offline': 1,
+    'offline_2': 2,
+    'e2e_scenario': 2
+}
 
 
-def query_recommendation_from_offline_data(prev_command, recommend_type, error_info):
-    query = generated_query_kql(prev_command, recommend_type, error_info)
+class RequestChargeCeilingExceeded(Exception):
+    '''The query of a low priority source is skipped because the request has used up its request units'''
 
-    return recommendation_container.query_items(query=query, enable_cross_partition_query=True)
+    def __init__(self, source, request_charge):
+        super().__init__('Skipped the query of {} after using {:.2f} RUs'.format(source, request_charge))
+        self.source = source
+        self.request_charge = request_charge
 
 
-def query_recommendation_from_offline_data_2(pprev_command, prev_command, recommend_type, error_info):
-    query = generated_query_kql(pprev_command + "|" + prev_command, recommend_type, error_info)
+def check_request_charge_ceiling(source, operation):
+    ceiling = float(os.environ.get("Cosmos_Request_RU_Ceiling", "0"))
+    priority = QUERY_PRIORITY.get((source, operation), QUERY_PRIORITY[source])
+    if ceiling <= 0 or priority < int(os.environ.get("Cosmos_RU_Ceiling_Skip_Priority", "1")):
+        return
+    diagnostics = get_request_diagnostics()
+    if diagnostics is not None and diagnostics.request_charge >= ceiling:
+        cosmos_metrics.record_skipped(source, operation)
+        diagnostics.properties.setdefault('ru_ceiling_skipped', []).append(source)
+        raise RequestChargeCeilingExceeded(source, diagnostics.request_charge)
 
-    return recommendation_container_2.query_items(query=query, enable_cross_partition_query=True)
 
+# The offline data and knowledge base are only updated by offline jobs, so their query results can be cached in the worker
+query_cache = TTLCache(max_size=int(os.environ.get("Cosmos_Cache_Size", "2048")),
+                       ttl=int(os.environ.get("Cosmos_Cache_TTL", "600")))
+pending_queries = {}
 
-def query_recommendation_from_e2e_scenario(prev_command, source_type):
+
+async def query_recommendation_from_knowledge_base(prev_command, recommend_type, error_info):
+    return await query_items_with_cache('knowledge_base', get_container("KnowledgeBase_Container"), prev_command, recommend_type, error_info, partitioned=False,
+                                        by_error_signature=os.environ.get("KnowledgeBase_Signature_Index") == "1")
+
+
+async def query_recommendation_from_offline_data(prev_command, recommend_type, error_info):
+    return await query_items_with_cache('offline', get_container("Recommendation_Container"), prev_command, recommend_type, error_info)
+
+
+async def query_recommendation_from_offline_data_2(pprev_command, prev_command, recommend_type, error_info):
+    return await query_items_with_cache('offline_2', get_container("Recommendation_Container_2"), pprev_command + "|" + prev_command, recommend_type, error_info)
+
+
+async def query_items_with_cache(source, container, command, recommend_type, error_info, partitioned=True, by_error_signature=False):
+    cache_key = (container.id, command, str(generated_cosmos_type(recommend_type, error_info)), get_error_signature(recommend_type, error_info))
+    # The refresh of a stale source result should get the latest data
+    items = query_cache.get(cache_key) if not is_revalidating() else None
+    if items is None:
+        # Concurrent requests of the same key share one in-flight query, e.g. the sessions of a batch request
+        query_future = pending_queries.get(cache_key)
+        if query_future is None:
+            check_request_charge_ceiling(source, 'query')
+            query_future = asyncio.ensure_future(query_items_by_command(source, container, command, recommend_type, error_info, partitioned, by_error_signature))
+            pending_queries[cache_key] = query_future
+            query_future.add_done_callback(lambda future: _complete_pending_query(cache_key, future))
+            # Cancelling one waiter should not cancel the query shared with other waiters
+            items = await asyncio.shield(query_future)
+        else:
+            try:
+                items = await asyncio.shield(query_future)
+            except RequestChargeCeilingExceeded:
+                # The shared query was skipped for the charge of the request which started it, not for this one
+                return await query_items_with_cache(source, container, command, recommend_type, error_info, partitioned, by_error_signature)
+
+    # The callers fill extra fields into the returned items, so the cached items should not be shared with them
+    return copy.deepcopy(items)
+
+
+def _complete_pending_query(cache_key, future):
+    pending_queries.pop(cache_key, None)
+    if not future.cancelled() and future.exception() is None:
+        query_cache.set(cache_key, future.result())
+
+
+async def query_items_by_command(source, container, command, recommend_type, error_info, partitioned=True, by_error_signature=False):
+    '''`command` is the partition key of the offline data containers, so the query can be scoped to a single partition
+
+    With `by_error_signature`, the documents whose error template has the same signature are looked up first,
+    the `CONTAINS` query scanning the error information of all solutions is only the fallback
+    '''
+    if by_error_signature and get_error_signature(recommend_type, error_info):
+        query, parameters = generated_signature_query_kql(command, recommend_type, error_info)
+        items = await _query_items(source, 'signature_query', container, command, query, parameters, partitioned)
+        if items:
+            return items
+        operation = 'fallback_query'
+        check_request_charge_ceiling(source, operation)
+    else:
+        operation = 'query' if partitioned else 'cross_partition_query'
+
+    query, parameters = generated_query_kql(command, recommend_type, error_info)
+    return await _query_items(source, operation, container, command, query, parameters, partitioned)
+
+
+async def _query_items(source, operation, container, command, query, parameters, partitioned):
+    with record_cosmos_operation(source, operation, command) as cosmos_operation:
+        if partitioned:
+            items = [item async for item in container.query_items(query=query, parameters=parameters, partition_key=command, response_hook=cosmos_operation)]
+        else:
+            items = [item async for item in container.query_items(query=query, parameters=parameters, response_hook=cosmos_operation)]
+        cosmos_operation.item_count = len(items)
+    return items
+
+
+async def query_recommendation_from_e2e_scenario(prev_command, source_type):
+    check_request_charge_ceiling('e2e_scenario', 'query')
     qry = f'SELECT * FROM c where c.firstCommand = @cmd and c.source in ({",".join(["@src"+str(int(src)) for src in source_type])})'
-    return e2e_scenario_container.query_items(
-        query=qry,
-        parameters=[
-            {"name": "@cmd", "value": "az " + prev_command},
-        ] + [{"name": "@src"+str(int(src)), "value": src} for src in source_type],
-        enable_cross_partition_query=True,
-    )
+    with record_cosmos_operation('e2e_scenario', 'query', prev_command) as cosmos_operation:
+        # `firstCommand` is the partition key of the e2e scenario container
+        async for item in get_container("E2EScenario_Container").query_items(
+            query=qry,
+            parameters=[
+                {"name": "@cmd", "value": "az " + prev_command},
+            ] + [{"name": "@src"+str(int(src)), "value": src} for src in source_type],
+            partition_key="az " + prev_command,
+            response_hook=cosmos_operation,
+        ):
+            cosmos_operation.item_count += 1
+            yield item
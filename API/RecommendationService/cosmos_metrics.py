@@ -0,0 +1,221 @@
+'''Request charge, latency, item count and partition fan-out of the Cosmos operations
+
+Every Cosmos operation of `cosmos_helper` is recorded by a `CosmosOperation`, which is also its `response_hook`.
+The operations of the worker are aggregated by (source, operation) and by command key, the aggregates are logged as
+`CosmosMetrics` and exported to `Cosmos_Metrics_Export` (a file path or an http(s) URL) every
+`Cosmos_Metrics_Export_Interval` seconds, then a new window starts.
+'''
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from shared_code.diagnostics import record_request_charge
+
+# Commands beyond this number of keys in a window are aggregated as `OTHER_COMMANDS`
+OTHER_COMMANDS = '(other)'
+
+
+class CosmosOperation:
+    '''Collect the charge, pages and partition key ranges of one Cosmos operation through its response hook'''
+
+    def __init__(self, source, operation, command):
+        self.source = source
+        self.operation = operation
+        self.command = command
+        self.start = time.perf_counter()
+        self.request_charge = 0.0
+        self.pages = 0
+        self.partition_key_ranges = set()
+        self.item_count = 0
+        self.error = False
+
+    def __call__(self, response_headers, result):
+        record_request_charge(response_headers, result)
+        if not response_headers:
+            return
+        self.pages += 1
+        try:
+            self.request_charge += float(response_headers.get('x-ms-request-charge', 0))
+        except (TypeError, ValueError):
+            pass
+        partition_key_range = response_headers.get('x-ms-documentdb-partitionkeyrangeid')
+        if partition_key_range:
+            self.partition_key_ranges.add(partition_key_range)
+
+    @property
+    def fan_out(self):
+        # The single partition operations may not return the partition key range
+        return len(self.partition_key_ranges) or min(self.pages, 1)
+
+    @property
+    def latency(self):
+        return time.perf_counter() - self.start
+
+
+class CosmosMetrics:
+    '''Aggregates of the Cosmos operations in the current window'''
+
+    def __init__(self, max_commands=1000, top_commands=20, latency_samples=1000):
+        self.max_commands = max_commands
+        self.top_commands = top_commands
+        self.latency_samples = latency_samples
+        self.reset()
+
+    def reset(self):
+        self.window_start = time.time()
+        # (source, operation) -> aggregate
+        self.operations = {}
+        # (source, operation) -> recent latencies in ms
+        self.latencies = {}
+        # source -> command -> {'request_charge', 'calls'}
+        self.commands = {}
+
+    def _get_record(self, source, operation):
+        return self.operations.setdefault((source, operation), {
+            'calls': 0, 'errors': 0, 'skipped': 0, 'request_charge': 0.0, 'max_request_charge': 0.0,
+            'latency_ms': 0.0, 'items': 0, 'pages': 0, 'fan_out': 0, 'max_fan_out': 0
+        })
+
+    def record(self, operation):
+        record = self._get_record(operation.source, operation.operation)
+        latency_ms = operation.latency * 1000
+        record['calls'] += 1
+        record['errors'] += int(operation.error)
+        record['request_charge'] += operation.request_charge
+        record['max_request_charge'] = max(record['max_request_charge'], operation.request_charge)
+        record['latency_ms'] += latency_ms
+        record['items'] += operation.item_count
+        record['pages'] += operation.pages
+        record['fan_out'] += operation.fan_out
+        record['max_fan_out'] = max(record['max_fan_out'], operation.fan_out)
+        self.latencies.setdefault((operation.source, operation.operation), deque(maxlen=self.latency_samples)).append(latency_ms)
+
+        commands = self.commands.setdefault(operation.source, {})
+        command = operation.command if operation.command in commands or len(commands) < self.max_commands else OTHER_COMMANDS
+        command_record = commands.setdefault(command, {'request_charge': 0.0, 'calls': 0})
+        command_record['request_charge'] += operation.request_charge
+        command_record['calls'] += 1
+
+    def record_skipped(self, source, operation):
+        self._get_record(source, operation)['skipped'] += 1
+
+    def collect(self):
+        '''The aggregates of the window, with the means, the latency percentiles and the commands using the most RUs'''
+        operations = []
+        for (source, operation), record in self.operations.items():
+            calls = record['calls']
+            latencies = sorted(self.latencies.get((source, operation)) or [0.0])
+            operations.append(dict(
+                record,
+                source=source,
+                operation=operation,
+                request_charge=round(record['request_charge'], 2),
+                max_request_charge=round(record['max_request_charge'], 2),
+                latency_ms=round(record['latency_ms'], 2),
+                mean_request_charge=round(record['request_charge'] / calls, 2) if calls else 0,
+                mean_latency_ms=round(record['latency_ms'] / calls, 2) if calls else 0,
+                p50_latency_ms=round(_percentile(latencies, 50), 2),
+                p95_latency_ms=round(_percentile(latencies, 95), 2),
+                mean_fan_out=round(record['fan_out'] / calls, 2) if calls else 0))
+
+        top_commands = {}
+        for source, commands in self.commands.items():
+            ranked = sorted(commands.items(), key=lambda item: item[1]['request_charge'], reverse=True)[0: self.top_commands]
+            top_commands[source] = [{'command': command, 'request_charge': round(record['request_charge'], 2), 'calls': record['calls']}
+                                    for command, record in ranked]
+
+        now = time.time()
+        return {
+            'window_start': self.window_start,
+            'window_seconds': round(now - self.window_start, 2),
+            'request_charge': round(sum(record['request_charge'] for record in self.operations.values()), 2),
+            'operations': operations,
+            'top_commands': top_commands
+        }
+
+
+def _percentile(values, percentile):
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+cosmos_metrics = CosmosMetrics(max_commands=int(os.environ.get("Cosmos_Metrics_Max_Commands", "1000")),
+                               top_commands=int(os.environ.get("Cosmos_Metrics_Top_Commands", "20")))
+# Keep the export tasks referenced until they are done
+_export_tasks = set()
+
+
+@contextmanager
+def record_cosmos_operation(source, operation, command):
+    '''Record the operation in the block, the yielded `CosmosOperation` is the response hook and takes the item count'''
+    cosmos_operation = CosmosOperation(source, operation, command)
+    try:
+        yield cosmos_operation
+    except Exception:
+        cosmos_operation.error = True
+        raise
+    finally:
+        cosmos_metrics.record(cosmos_operation)
+        export_cosmos_metrics()
+
+
+def export_cosmos_metrics(force=False):
+    '''Start a new window and export the metrics of the last one, when the export interval has passed or `force` is set
+
+    The operations call it when they finish, so the log and the export run in a background task and the file is written
+    in the thread pool, the event loop only collects the aggregates.
+
+    Returns:
+        dict: the exported metrics, None when the window is not over
+    '''
+    interval = float(os.environ.get("Cosmos_Metrics_Export_Interval", "60"))
+    if not force and (interval <= 0 or time.time() - cosmos_metrics.window_start < interval):
+        return None
+
+    data = cosmos_metrics.collect()
+    cosmos_metrics.reset()
+    target = os.environ.get("Cosmos_Metrics_Export")
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Without an event loop there is nothing to block
+        _write_metrics(target, data)
+        return data
+    task = loop.create_task(_export_metrics(target, data))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
+    return data
+
+
+async def _export_metrics(target, data):
+    await asyncio.get_running_loop().run_in_executor(None, _write_metrics, target, data)
+    if target and (target.startswith('http://') or target.startswith('https://')):
+        await _post_metrics(target, data)
+
+
+def _write_metrics(target, data):
+    '''Log the metrics and append them to the file of the target, the http(s) targets are posted by `_post_metrics`'''
+    line = json.dumps(data)
+    logging.info('CosmosMetrics: %s', line)
+    if not target or target.startswith('http://') or target.startswith('https://'):
+        return
+    try:
+        with open(target, 'a') as f:
+            f.write(line + '\n')
+    except OSError as e:
+        logging.warning('Failed to export the Cosmos metrics to {}: {}'.format(target, e))
+
+
+async def _post_metrics(url, data):
+    import aiohttp
+
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+            async with session.post(url, json=data) as response:
+                if response.status >= 300:
+                    logging.warning('Failed to export the Cosmos metrics to {}: {}'.format(url, response.status))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning('Failed to export the Cosmos metrics to {}: {}'.format(url, repr(e)))
@@ -0,0 +1,36 @@
+'''Ingest the error signatures of the knowledge base
+
+Every solution document gets the field `errorSignature`, the hash of its error template computed by
+`generated_error_signature`, so a solution request can look up the documents of (command, signature) with an
+equality filter instead of scanning the error information of every solution with `CONTAINS`.
+
+Run `python -m RecommendationService.error_signature` in the `API` folder after the knowledge base is updated,
+then enable the lookup with `KnowledgeBase_Signature_Index=1`.
+'''
+import asyncio
+
+from .util import CosmosType, generated_error_signature
+
+
+async def update_error_signatures():
+    '''Set the error signature of the solution documents whose signature is missing or outdated'''
+    from .cosmos_helper import get_container
+
+    knowledge_base_container = get_container("KnowledgeBase_Container")
+
+    updated_count = 0
+    async for item in knowledge_base_container.read_all_items():
+        if item.get('type') != CosmosType.Solution or not item.get('errorInformation'):
+            continue
+        error_signature = generated_error_signature(item['errorInformation'])
+        if item.get('errorSignature') == error_signature:
+            continue
+        item = {key: value for key, value in item.items() if not key.startswith('_')}
+        item['errorSignature'] = error_signature
+        await knowledge_base_container.upsert_item(item)
+        updated_count += 1
+    return updated_count
+
+
+if __name__ == '__main__':
+    print('Updated the error signatures of {} solutions'.format(asyncio.run(update_error_signatures())))
@@ -1,24 +1,24 @@
-import json
-
 from .util import RecommendType
 
 
-def filter_recommendation_result(recommendation_result, command_list, command_top_num=5, scenario_top_num=5):
-    if not recommendation_result or not command_list:
-        return recommendation_result
-    command_data = json.loads(command_list)
-    if len(command_data) == 0:
+def is_filtered_item(item, session):
+    '''Whether the item is never recommended to the session: the current command or a command deleting resources'''
+    if item['type'] != RecommendType.Command or not session.commands:
+        return False
+    return item['command'] == session.commands[-1] or 'delete' in item['command']
+
+
+def filter_recommendation_result(recommendation_result, session, command_top_num=5, scenario_top_num=5):
+    if not recommendation_result or not session.commands:
         return recommendation_result
 
-    filter_command = json.loads(command_data[-1])['command']
     scenario_count = 0
     command_count = 0
     filter_result = []
     for item in recommendation_result:
         if item['type'] != RecommendType.Scenario:
-            if item['type'] == RecommendType.Command:
-                if item['command'] == filter_command or 'delete' in item['command']:
-                    continue
+            if is_filtered_item(item, session):
+                continue
             if command_count >= command_top_num:
                 continue
             else:
@@ -0,0 +1,148 @@
+import heapq
+import os
+from enum import Enum
+
+from .util import RecommendationSource
+
+
+class FusionStrategy(str, Enum):
+    # Take the items of each source in turn, this is the default strategy
+    Interleave = 'interleave'
+    # Take all items of a source before the items of the next source
+    Priority = 'priority'
+    # Score each item by the weight of its source and its rank in the source
+    Weighted = 'weighted'
+    # Reciprocal rank fusion
+    RRF = 'rrf'
+
+
+# The constant of reciprocal rank fusion, which dampens the impact of the top ranked items
+RRF_K = 60
+
+
+def get_fusion_strategy():
+    try:
+        return FusionStrategy(os.environ.get("Recommendation_Fusion_Strategy", FusionStrategy.Interleave.value).lower())
+    except ValueError:
+        return FusionStrategy.Interleave
+
+
+def get_source_priority():
+    '''The knowledge base comes first, `Recommendation_Prefer` decides whether the offline calculation goes before Aladdin'''
+    if os.environ.get("Recommendation_Prefer") == "1":
+        return [RecommendationSource.KnowledgeBase, RecommendationSource.OfflineCaculation, RecommendationSource.Aladdin]
+    return [RecommendationSource.KnowledgeBase, RecommendationSource.Aladdin, RecommendationSource.OfflineCaculation]
+
+
+def get_source_weights():
+    '''Parse `Recommendation_Fusion_Weights` in the format of `<source>:<weight>,...`, e.g. `2:1.5,3:1`'''
+    weights = {source: 1.0 for source in RecommendationSource}
+    for pair in os.environ.get("Recommendation_Fusion_Weights", "").split(','):
+        if ':' not in pair:
+            continue
+        source, weight = pair.split(':', 1)
+        try:
+            weights[RecommendationSource(int(source))] = float(weight)
+        except ValueError:
+            continue
+    return weights
+
+
+# The configuration is read once per worker instead of per merged item
+fusion_strategy = get_fusion_strategy()
+source_priority = get_source_priority()
+source_weights = get_source_weights()
+
+
+def fuse_recommendation_items(source_items, top_num=None, strategy=None):
+    '''Merge the items of multiple sources into one list without duplicate commands
+
+    The items of the knowledge base are always placed first, the items of the other sources are merged by the strategy.
+
+    Args:
+        source_items (dict): RecommendationSource -> list of items sorted by relevance
+        top_num (int, optional): the max number of merged items, all items are kept when it is None
+        strategy (FusionStrategy, optional): defaults to `Recommendation_Fusion_Strategy`
+
+    Returns:
+        list[dict]: merged items
+    '''
+    strategy = strategy or fusion_strategy
+    sources = [source for source in source_priority if source in source_items]
+    sources.extend(source for source in source_items if source not in sources)
+
+    result = []
+    exist_commands = set()
+    pinned_items = source_items.get(RecommendationSource.KnowledgeBase) or []
+    for item in pinned_items:
+        result.append(item)
+        if 'command' in item:
+            exist_commands.add(item['command'])
+
+    ranked_items = [source_items[source] or [] for source in sources if source != RecommendationSource.KnowledgeBase]
+    ranked_sources = [source for source in sources if source != RecommendationSource.KnowledgeBase]
+    remaining_num = None if top_num is None else max(top_num - len(result), 0)
+
+    if strategy == FusionStrategy.Priority:
+        merged_items = _merge_in_order(ranked_items, exist_commands, remaining_num)
+    elif strategy in (FusionStrategy.Weighted, FusionStrategy.RRF):
+        merged_items = _merge_by_score(ranked_sources, ranked_items, exist_commands, strategy, remaining_num)
+    else:
+        merged_items = _merge_interleaved(ranked_items, exist_commands, remaining_num)
+
+    result.extend(merged_items)
+    return result if top_num is None else result[0: top_num]
+
+
+def _merge_interleaved(ranked_items, exist_commands, top_num):
+    # Take the items of the sources in turn until any source is exhausted, then take the remaining items source by source
+    common_length = min((len(items) for items in ranked_items), default=0)
+    interleaved_items = [items[index] for index in range(common_length) for items in ranked_items]
+    remaining_items = [item for items in ranked_items for item in items[common_length:]]
+    return _merge_unique(interleaved_items + remaining_items, exist_commands, top_num)
+
+
+def _merge_in_order(ranked_items, exist_commands, top_num):
+    return _merge_unique([item for items in ranked_items for item in items], exist_commands, top_num)
+
+
+def _merge_unique(items, exist_commands, top_num):
+    result = []
+    for item in items:
+        if top_num is not None and len(result) >= top_num:
+            break
+        if item['command'] not in exist_commands:
+            result.append(item)
+            exist_commands.add(item['command'])
+    return result
+
+
+def _merge_by_score(ranked_sources, ranked_items, exist_commands, strategy, top_num):
+    scores = {}
+    first_items = {}
+    for source, items in zip(ranked_sources, ranked_items):
+        weight = source_weights.get(source, 1.0)
+        for rank, item in enumerate(items):
+            command = item['command']
+            if command in exist_commands:
+                continue
+            if strategy == FusionStrategy.RRF:
+                score = weight / (RRF_K + rank + 1)
+            else:
+                score = weight * (len(items) - rank) / len(items)
+            scores[command] = scores.get(command, 0) + score
+            # Keep the item from the source with the higher priority for duplicate commands
+            first_items.setdefault(command, (len(first_items), item))
+
+    # The items with the same score keep the order in which they appear
+    candidates = ((score, -first_items[command][0], command) for command, score in scores.items())
+    if top_num is None:
+        selected = sorted(candidates, reverse=True)
+    else:
+        selected = heapq.nlargest(top_num, candidates)
+
+    result = []
+    for _, _, command in selected:
+        result.append(first_items[command][1])
+        exist_commands.add(command)
+    return result
@@ -1,13 +1,21 @@
 from .cosmos_helper import query_recommendation_from_knowledge_base
-from .util import get_latest_cmd, RecommendationSource, RecommendType
+from .source_cache import get_source_result
+from .util import RecommendationSource, RecommendType, generated_cosmos_type, get_error_signature
 
 
-def get_recommend_from_knowledge_base(command_list, recommend_type, error_info, top_num=50):
+async def get_recommend_from_knowledge_base(session, recommend_type, error_info, top_num=50):
 
-    commands = get_latest_cmd(command_list)
+    commands = session.latest_commands()
+
+    cache_key = (commands[-1], str(generated_cosmos_type(recommend_type, error_info)), get_error_signature(recommend_type, error_info), bool(error_info), top_num)
+    return await get_source_result('knowledge_base', cache_key,
+                                   lambda: load_recommend_from_knowledge_base(commands[-1], recommend_type, error_info, top_num))
+
+
+async def load_recommend_from_knowledge_base(command, recommend_type, error_info, top_num=50):
 
     result = []
-    knowledge_base_items = list(query_recommendation_from_knowledge_base(commands[-1], recommend_type, error_info))
+    knowledge_base_items = await query_recommendation_from_knowledge_base(command, recommend_type, error_info)
     if knowledge_base_items:
         for item in knowledge_base_items:
             if 'nextCommand' in item:
@@ -1,38 +1,67 @@
 import asyncio
 import os
 
-from .cosmos_helper import query_recommendation_from_offline_data, query_recommendation_from_offline_data_2
-from .util import get_latest_cmd, RecommendationSource, RecommendType, generated_cosmos_type, CosmosType
+from shared_code.diagnostics import measure_async_stage
 
+from .cosmos_helper import RequestChargeCeilingExceeded, query_recommendation_from_offline_data, query_recommendation_from_offline_data_2
+from .snapshot import get_offline_snapshot, query_precomputed_recommendation, query_recommendation_from_snapshot, query_recommendation_from_snapshot_2, use_offline_snapshot
+from .source_cache import get_source_result
+from .util import RecommendationSource, RecommendType, generated_cosmos_type, get_error_signature, CosmosType
 
-async def get_recommend_from_offline_data(command_list, recommend_type, error_info, top_num=50):
-    loop = asyncio.get_event_loop()
+
+async def get_recommend_from_offline_data(session, recommend_type, error_info, top_num=50):
     cosmos_type = generated_cosmos_type(recommend_type, error_info)
-    commands = get_latest_cmd(command_list, 2)
+    # The solutions only depend on the last command
+    commands = session.latest_commands(1 if cosmos_type == CosmosType.Solution else 2)
+    cache_key = (tuple(commands), str(cosmos_type), get_error_signature(recommend_type, error_info), bool(error_info), top_num)
+    return await get_source_result('offline', cache_key,
+                                   lambda: load_recommend_from_offline_data(commands, recommend_type, error_info, top_num))
 
-    totalcount_threshold = int(os.environ["Solution_TotalCount_Threshold"]) if cosmos_type == CosmosType.Solution else int(os.environ["Command_TotalCount_Threshold"])
-    ratio_threshold = int(os.environ["Solution_Ratio_Threshold"]) if cosmos_type == CosmosType.Solution else int(os.environ["Command_Ratio_Threshold"])
 
-    if cosmos_type == CosmosType.Solution:
-        return get_recommend_from_cosmos(commands[-1:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)
-    else:
-        # The recommended content matching the last two commands is preferred. If there is no data, it will fall back to the situation of matching the last command
-        result_2_future = loop.run_in_executor(None, get_recommend_from_cosmos, commands[-2:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)
-        result_future = loop.run_in_executor(None, get_recommend_from_cosmos, commands[-1:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)
+async def load_recommend_from_offline_data(commands, recommend_type, error_info, top_num=50):
+    cosmos_type = generated_cosmos_type(recommend_type, error_info)
 
-        result_2 = await result_2_future
-        if len(result_2) >= top_num:
-            return result_2
-        else:
-            return result_2 + await result_future
+    # The snapshot may hold the results computed at export, then the lookup is only a slice of them
+    if cosmos_type is not None and not error_info and use_offline_snapshot() and get_offline_snapshot().has_precomputed_data():
+        return query_precomputed_recommendation(commands, cosmos_type, top_num)
 
+    totalcount_threshold, ratio_threshold = get_thresholds(cosmos_type)
 
-def get_recommend_from_cosmos(commands, recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num=50):
-    if len(commands) == 2:
-        query_items = list(query_recommendation_from_offline_data_2(commands[-2], commands[-1], recommend_type, error_info))
+    if cosmos_type == CosmosType.Solution:
+        return await get_recommend_from_cosmos(commands[-1:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)
     else:
-        query_items = list(query_recommendation_from_offline_data(commands[-1], recommend_type, error_info))
-
+        # The recommended content matching the last two commands is preferred. If there is no data, it will fall back to the situation of matching the last command
+        result_2_future = asyncio.ensure_future(measure_async_stage('offline_bigram', get_recommend_from_cosmos(commands[-2:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)))
+        result_future = asyncio.ensure_future(measure_async_stage('offline_unigram', get_recommend_from_cosmos(commands[-1:], recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num)))
+
+        try:
+            try:
+                result_2 = await result_2_future
+            except RequestChargeCeilingExceeded:
+                # The query of the last two commands has the lower priority, the last command is still queried
+                result_2 = []
+            if len(result_2) >= top_num:
+                return result_2
+            try:
+                return result_2 + await result_future
+            except RequestChargeCeilingExceeded:
+                # The items of the last two commands are still returned when the query of the last command is skipped
+                return result_2
+        finally:
+            if not result_future.done():
+                result_future.cancel()
+            elif not result_future.cancelled():
+                # Retrieve the exception of the unused query, so it is not reported as never retrieved
+                result_future.exception()
+
+
+async def get_recommend_from_cosmos(commands, recommend_type, error_info, totalcount_threshold, ratio_threshold, top_num=50):
+    query_items = await query_offline_items(commands, recommend_type, error_info)
+    return build_recommend_items(query_items, commands, error_info, totalcount_threshold, ratio_threshold)[0: top_num]
+
+
+def build_recommend_items(query_items, commands, error_info, totalcount_threshold, ratio_threshold):
+    '''Compute the ratio of the next commands, drop the ones under the thresholds and sort the rest by ratio'''
     result = []
     for item in query_items:
         if item['totalCount'] < totalcount_threshold:
@@ -62,7 +91,25 @@ def get_recommend_from_cosmos(commands, recommend_type, error_info, totalcount_t
     if result:
         result = sorted(result, key=lambda x: x['ratio'], reverse=True)
 
-    return result[0: top_num]
+    return result
+
+
+async def query_offline_items(commands, recommend_type, error_info):
+    if use_offline_snapshot():
+        if len(commands) == 2:
+            return query_recommendation_from_snapshot_2(commands[-2], commands[-1], recommend_type, error_info)
+        return query_recommendation_from_snapshot(commands[-1], recommend_type, error_info)
+
+    if len(commands) == 2:
+        return await query_recommendation_from_offline_data_2(commands[-2], commands[-1], recommend_type, error_info)
+    return await query_recommendation_from_offline_data(commands[-1], recommend_type, error_info)
+
+
+def get_thresholds(cosmos_type):
+    '''Get the thresholds of the total count and the usage ratio (in percent) of the cosmos type'''
+    if cosmos_type == CosmosType.Solution:
+        return int(os.environ["Solution_TotalCount_Threshold"]), int(os.environ["Solution_Ratio_Threshold"])
+    return int(os.environ["Command_TotalCount_Threshold"]), int(os.environ["Command_Ratio_Threshold"])
 
 
 def get_usage_condition(ratio):
@@ -1,39 +1,95 @@
-from .util import get_latest_cmd, RecommendType
+import os
 
+from shared_code.cache import TTLCache
 
-def analyze_personal_path(recommendation_result, command_list):
-    if not recommendation_result or not command_list:
-        return recommendation_result
+from .util import RecommendType
+
+# The number of latest consumed commands remembered for a session, used to locate the new commands of its next request
+TAIL_LENGTH = 3
+# The number of sessions (e.g. terminals or the sessions of batch requests) tracked for a user
+MAX_SESSIONS = int(os.environ.get("Personalization_Max_Sessions", "8"))
+
+
+class TransitionModel:
+    '''Counts of the next command after each pair of commands in the history of a user'''
+
+    def __init__(self):
+        # (previous command, current command) -> {next command: count}
+        self.transitions = {}
+        # (previous command, current command) -> (most used next command, count)
+        self.most_used = {}
+        # The consumed position of each session of the user, most recent first: [(history length, tail)]
+        self.sessions = []
+
+    def add_transition(self, prev_command, cur_command, next_command):
+        trigger = (prev_command, cur_command)
+        next_commands = self.transitions.setdefault(trigger, {})
+        count = next_commands.get(next_command, 0) + 1
+        next_commands[next_command] = count
+        # The command which reaches the highest frequency first is the most used one
+        if count > self.most_used.get(trigger, (None, 0))[1]:
+            self.most_used[trigger] = (next_command, count)
+
+    def update(self, commands):
+        '''Consume the commands which have not been counted yet, so the cost only depends on the number of new commands
+
+        The history continues the session whose consumed tail it contains. When it contains no tail, it is a new session
+        or a window after all consumed commands of its session, so all of its commands are new.
+        '''
+        start = 0
+        for session_index, (history_length, tail) in enumerate(self.sessions):
+            new_start = _find_new_commands(commands, history_length, tail)
+            if new_start is not None:
+                start = new_start
+                del self.sessions[session_index]
+                break
+        for index in range(max(start, 2), len(commands)):
+            self.add_transition(commands[index - 2], commands[index - 1], commands[index])
+        if commands:
+            self.sessions.insert(0, (len(commands), tuple(commands[-TAIL_LENGTH:])))
+            del self.sessions[MAX_SESSIONS:]
 
-    personal_command_list = get_latest_cmd(command_list, 0)
-    personal_path = ','.join(personal_command_list)
+    def get_most_used_command(self, prev_command, cur_command):
+        most_used = self.most_used.get((prev_command, cur_command))
+        return most_used[0] if most_used else None
 
-    trigger_command_list = get_latest_cmd(command_list, 2)
-    trigger_path = ','.join(trigger_command_list)
 
-    path_array = personal_path.split(trigger_path)
-    if not path_array or len(path_array) < 2:
+def _find_new_commands(commands, history_length, tail):
+    '''Get the index of the first new command after the consumed tail, None when the commands do not contain the tail'''
+    tail_length = len(tail)
+    # The history is extended with new commands
+    if len(commands) >= history_length and tuple(commands[history_length - tail_length: history_length]) == tail:
+        return history_length
+    # The history is a sliding window, find the latest position of the consumed commands
+    for start in range(len(commands) - tail_length, -1, -1):
+        if tuple(commands[start: start + tail_length]) == tail:
+            return start + tail_length
+    return None
+
+
+# The models of users are kept in a bounded store and updated incrementally by their requests
+user_models = TTLCache(max_size=int(os.environ.get("Personalization_Model_Cache_Size", "10000")),
+                       ttl=int(os.environ.get("Personalization_Model_TTL", "86400")))
+
+
+def get_transition_model(session, user_id=None):
+    model = user_models.get(user_id) if user_id else None
+    if model is None:
+        model = TransitionModel()
+    model.update(session.commands)
+    if user_id:
+        user_models.set(user_id, model)
+    return model
+
+
+def analyze_personal_path(recommendation_result, session, user_id=None):
+    if not recommendation_result or len(session.commands) < 2:
         return recommendation_result
 
-    path_array = path_array[1:]
-    command_frequency = {}
-    most_used_command = ""
-    highest_frequency = 0
-    for next_paths in path_array:
-        if not next_paths:
-            continue
-        path_item = next_paths.split(',')
-        if len(path_item) < 2:
-            continue
-
-        next_command = path_item[1]
-        if next_command not in command_frequency:
-            command_frequency[next_command] = 1
-        else:
-            command_frequency[next_command] = command_frequency[next_command] + 1
-        if command_frequency[next_command] > highest_frequency:
-            highest_frequency = command_frequency[next_command]
-            most_used_command = next_command
+    model = get_transition_model(session, user_id)
+    most_used_command = model.get_most_used_command(session.commands[-2], session.commands[-1])
+    if not most_used_command:
+        return recommendation_result
 
     personalized_command_item = None
     for item in recommendation_result:
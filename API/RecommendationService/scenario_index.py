@@ -0,0 +1,114 @@
+import heapq
+import os
+import threading
+
+from shared_code.scenario_search import load_snapshot_documents
+
+from .util import RecommendationSource, RecommendType
+
+
+class ScenarioCommandIndex:
+    """In-memory index from every command of the scenarios to the scenarios containing it
+
+    The command sets are stripped of `az ` when the index is built. The postings of each command are the sorted ids
+    of the scenarios containing it, so a request only visits the scenarios matching its trigger commands.
+    """
+
+    def __init__(self, documents):
+        # Scenario id -> (recommended scenario without executeIndex, number of commands, command -> positions)
+        self.scenarios = []
+        # Command -> sorted tuple of scenario ids
+        self.postings = {}
+        for document in documents:
+            command_set = document.get('commandSet') or []
+            # Same as the commands used by `executeIndex` in `get_scenario_recommendation_from_search`
+            commands = [command['command'][3:] for command in command_set if len(command.get('command') or '') > 3]
+            command_positions = {}
+            for position, command in enumerate(commands):
+                command_positions.setdefault(command, []).append(position)
+
+            scenario = {
+                'scenario': document['name'],
+                'nextCommandSet': [dict(command, command=command['command'][3:]) for command in command_set
+                                   if command.get('command') and command['command'].startswith('az ')],
+                'source': RecommendationSource.Search,
+                'type': RecommendType.Scenario
+            }
+            if 'description' in document:
+                scenario['reason'] = document['description']
+
+            scenario_id = len(self.scenarios)
+            self.scenarios.append((scenario, len(commands), {command: tuple(positions) for command, positions in command_positions.items()}))
+            for command in command_positions:
+                self.postings.setdefault(command, []).append(scenario_id)
+        # The ids are appended in increasing order, so the postings are already sorted
+        self.postings = {command: tuple(scenario_ids) for command, scenario_ids in self.postings.items()}
+
+    def get_scenarios(self, trigger_commands, top_num=5):
+        """Get the scenarios containing the last command, ranked by the number of trigger commands they contain
+
+        It keeps the semantics of the search query `"last" OR (("first" OR "second") AND "last")`: the last command
+        must be matched, and the scenarios matching more of the other trigger commands score higher.
+
+        Args:
+            trigger_commands (List[str]): latest commands without `az `, the last one is the current command
+            top_num (int, optional): top num of returned results. Defaults to 5.
+
+        Returns:
+            list[dict]: recommended scenarios with `executeIndex` of the commands not executed yet
+        """
+        if not trigger_commands:
+            return []
+        trigger_command_set = set(trigger_commands)
+        # Scenario id -> number of trigger commands in the scenario, the candidates all contain the last command
+        matched_counts = dict.fromkeys(self.postings.get(trigger_commands[-1], ()), 1)
+        if not matched_counts:
+            return []
+        for command in trigger_command_set - {trigger_commands[-1]}:
+            for scenario_id in self.postings.get(command, ()):
+                if scenario_id in matched_counts:
+                    matched_counts[scenario_id] += 1
+
+        # The scenarios matching more trigger commands go first, then the shorter ones which are more specific
+        ranked = [(-matched_count, self.scenarios[scenario_id][1], scenario_id) for scenario_id, matched_count in matched_counts.items()]
+        heapq.heapify(ranked)
+
+        results = []
+        while ranked and len(results) < top_num:
+            negative_matched_count, command_count, scenario_id = heapq.heappop(ranked)
+            scenario, _, command_positions = self.scenarios[scenario_id]
+            executed = set()
+            for command in trigger_command_set:
+                executed.update(command_positions.get(command, ()))
+            execute_index = [position for position in range(command_count) if position not in executed]
+            # Avoid recommending scenarios to users which they have executed all commands
+            if not execute_index:
+                continue
+            scenario = dict(scenario)
+            scenario['nextCommandSet'] = [dict(command) for command in scenario['nextCommandSet']]
+            scenario['executeIndex'] = execute_index
+            scenario['score'] = float(-negative_matched_count)
+            results.append(scenario)
+        return results
+
+
+_scenario_index = None
+_scenario_index_lock = threading.Lock()
+
+
+def use_scenario_index():
+    return os.environ.get("Scenario_Recommendation_Index", "") == "1"
+
+
+def get_scenario_index():
+    """Lazily build the index from the scenario snapshot, one per worker
+
+    Returns:
+        ScenarioCommandIndex: index of the scenarios in `Scenario_Search_Snapshot_Path`
+    """
+    global _scenario_index
+    if _scenario_index is None:
+        with _scenario_index_lock:
+            if _scenario_index is None:
+                _scenario_index = ScenarioCommandIndex(load_snapshot_documents(os.environ["Scenario_Search_Snapshot_Path"]))
+    return _scenario_index
@@ -1,12 +1,33 @@
 import os
+import threading
 from typing import List
 
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from shared_code.scenario_search import get_scenario_search_engine, use_embedded_search
 
 from .cosmos_helper import query_recommendation_from_e2e_scenario
-from .util import (RecommendationSource, RecommendType, ScenarioSourceType,
-                   get_latest_cmd)
+from .scenario_index import get_scenario_index, use_scenario_index
+from .util import RecommendationSource, RecommendType, ScenarioSourceType
+
+_search_client = None
+_search_client_lock = threading.Lock()
+
+
+def get_search_client():
+    """Get the search client shared by all requests in the worker, so that the HTTP connections are kept warm
+
+    Returns:
+        SearchClient: async client of the scenario search index
+    """
+    global _search_client
+    if _search_client is None:
+        with _search_client_lock:
+            if _search_client is None:
+                from azure.core.credentials import AzureKeyCredential
+                from azure.search.documents.aio import SearchClient
+                _search_client = SearchClient(endpoint=os.environ["SCENARIO_SEARCH_SERVICE_ENDPOINT"],
+                                              index_name=os.environ["SCENARIO_SEARCH_INDEX"],
+                                              credential=AzureKeyCredential(os.environ["SCENARIO_SEARCH_SERVICE_SEARCH_KEY"]))
+    return _search_client
 
 
 def strip_az_in_command_set(command_set):
@@ -26,12 +47,12 @@ def strip_az_in_command_set(command_set):
     return result
 
 
-def get_scenario_recommendation(command_list, top_num=50):
+async def get_scenario_recommendation(session, top_num=50):
     source_type: List[ScenarioSourceType] = [ScenarioSourceType.SAMPLE_REPO]
-    commands = get_latest_cmd(command_list)
+    commands = session.latest_commands()
 
     result = []
-    for item in query_recommendation_from_e2e_scenario(commands[-1], source_type):
+    async for item in query_recommendation_from_e2e_scenario(commands[-1], source_type):
         if len(item['commandSet']) > 1:
             scenario = {
                 'scenario': item['name'],
@@ -46,8 +67,8 @@ def get_scenario_recommendation(command_list, top_num=50):
     return result[0: top_num]
 
 
-def get_search_results(trigger_commands: List[str], top: int = 5):
-    """Search related sceanrios using cognitive search
+async def get_search_results(trigger_commands: List[str], top: int = 5):
+    """Search related sceanrios using cognitive search, or the embedded search engine when it is configured
 
     Args:
         trigger_commands (List[str]): list of commands used to search
@@ -58,49 +79,49 @@ def get_search_results(trigger_commands: List[str], top: int = 5):
     """
     if len(trigger_commands) == 0:
         return []
-    service_endpoint = os.environ["SCENARIO_SEARCH_SERVICE_ENDPOINT"]
-    search_client = SearchClient(endpoint=service_endpoint,
-                                 index_name=os.environ["SCENARIO_SEARCH_INDEX"],
-                                 credential=AzureKeyCredential(os.environ["SCENARIO_SEARCH_SERVICE_SEARCH_KEY"]))
     search_statement = ""
     if len(trigger_commands) > 1:
         search_statement = "(" + " OR ".join([f'"{cmd}"' for cmd in trigger_commands][:-1]) + ") AND "
     search_statement = search_statement + f'"{trigger_commands[-1]}"'
     search_statement = f'"{trigger_commands[-1]}" OR ({search_statement})'
-    results = search_client.search(
+    if use_embedded_search():
+        return get_scenario_search_engine().search(search_statement, top=top, search_fields=["commandSet/command"])
+    results = await get_search_client().search(
         search_text=search_statement,
         include_total_count=True,
         search_fields=["commandSet/command"],
         highlight_fields="commandSet/command",
         top=top,
         query_type='full')
-    results = list(results)
+    results = [result async for result in results]
     return results
 
 
-def get_scenario_recommendation_from_search(command_list, top_num=5):
+async def get_scenario_recommendation_from_search(session, top_num=5):
     """Recommend Scenarios that current context could be in
 
     Args:
-        command_list (list[str]): commands used to trigger
+        session (CommandSession): parsed command history used to trigger
         top_num (int, optional): top num of recommended results. Defaults to 5.
 
     Returns:
         list[dict]: searched scenarios
     """
-    if len(command_list) == 0:
-        return []
     trigger_len = int(os.environ.get("ScenarioRecommendationTriggerLength", "3"))
-    trigger_commands = get_latest_cmd(command_list, trigger_len)
+    trigger_commands = session.latest_commands(trigger_len)
     trigger_commands = [cmd[3:] if cmd.startswith("az ") else cmd for cmd in trigger_commands]
-    searched = get_search_results(trigger_commands, top_num)
+    if use_scenario_index():
+        return get_scenario_index().get_scenarios(trigger_commands, top_num)
+
+    searched = await get_search_results(trigger_commands, top_num)
+    trigger_command_set = set(trigger_commands)
 
     results = []
     for item in searched:
         # get all commands in searched scenario with `az ` stripped
         cmds = [cmd['command'][3:] for cmd in item['commandSet'] if len(cmd['command']) > 3]
         # get indices of commands that the user has not executed yet, which need to be executed
-        execute_index = [idx for idx, cmd in enumerate(cmds) if cmd not in trigger_commands]
+        execute_index = [idx for idx, cmd in enumerate(cmds) if cmd not in trigger_command_set]
         # avoid recommending scenarios to users which they have executed all commands
         if len(execute_index) == 0:
             continue
@@ -0,0 +1,48 @@
+import json
+from typing import FrozenSet, NamedTuple, Tuple
+
+# If there is no command has been executed before, assume that the user's first command is "group create"
+DEFAULT_COMMAND = "group create"
+
+
+class CommandSession(NamedTuple):
+    '''The command history of a request, parsed once and shared by all recommendation sources and stages'''
+    commands: Tuple[str, ...]
+    arguments: Tuple[Tuple[str, ...], ...]
+    # The commands in the format of Aladdin model: `command arg1 *** arg2 ***` with arguments sorted
+    aladdin_commands: Tuple[str, ...]
+    command_set: FrozenSet[str]
+
+    def latest_commands(self, num=1):
+        '''Get the latest `num` commands, all commands are returned when `num` is 0'''
+        if not self.commands:
+            return [DEFAULT_COMMAND]
+        return list(self.commands[-num:])
+
+
+def parse_command_list(command_list):
+    '''Parse the `command_list` parameter, which is a JSON list of JSON encoded command items
+
+    Raises:
+        ValueError: `command_list` is not in the expected format
+    '''
+    try:
+        command_data = json.loads(command_list)
+        if not isinstance(command_data, list):
+            raise ValueError('command_list must be a JSON list')
+        command_items = [json.loads(command_item) for command_item in command_data]
+        commands = tuple(command_item['command'] for command_item in command_items)
+    except (TypeError, KeyError) as e:
+        raise ValueError(str(e)) from e
+
+    arguments = tuple(tuple(command_item.get('arguments') or ()) for command_item in command_items)
+    aladdin_commands = tuple(_get_aladdin_command(command_item) for command_item in command_items)
+    return CommandSession(commands, arguments, aladdin_commands, frozenset(commands))
+
+
+def _get_aladdin_command(command_item):
+    command_data = command_item['command']
+    if 'arguments' in command_item:
+        # parameters in the model is already sorted in alphabetical order, so the parameters we pass in should also keep this rule
+        command_data = '{} {}'.format(command_data, ' *** '.join(sorted(command_item['arguments'])) + ' ***')
+    return command_data
@@ -0,0 +1,262 @@
+'''Local snapshot of the offline recommendation data
+
+The snapshot is a single file holding the documents of the recommendation-without-arguments container and
+the two-command container, so that the offline data can be served without a round trip to Cosmos.
+
+File layout (all integers are little-endian uint32):
+
+    | magic | count | index entries (count * [key_offset, key_len, value_offset, value_len]) | keys and values |
+
+The index entries are sorted by key, and a key is `<container tag>\0<command>`. The value is the JSON encoded list
+of documents matching the command, with `nextCommand` already sorted by count. The file is memory-mapped,
+so all worker processes on a host share one copy of the data through the page cache.
+
+The export also computes the offline recommendations of every command and pair of commands (ratios, threshold
+cutoffs and the fallback from two commands to the last command, sorted by ratio) with the thresholds configured at
+that time, so a request without error information only slices the stored list. When the thresholds configured in
+the worker differ from the ones of the export, the documents are used instead.
+
+Export a snapshot from Cosmos by running `python -m RecommendationService.snapshot <path>` in the `API` folder.
+'''
+import asyncio
+import copy
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from .util import RecommendType, generated_cosmos_type, get_cosmos_type_values, need_error_info, parse_error_info
+
+SNAPSHOT_MAGIC = b'CLISNAP1'
+HEADER_FORMAT = '<8sI'
+INDEX_ENTRY_FORMAT = '<IIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+
+
+class SnapshotContainer:
+    Recommendation = '1'
+    Recommendation_2 = '2'
+    # The precomputed recommendations, the key is `<cosmos type>\0<command or pair of commands>`
+    Precomputed = 'P'
+    Metadata = 'M'
+
+
+# The cosmos types of the offline recommendations without error information
+PRECOMPUTED_COSMOS_TYPES = ['3,1', '1', '2']
+
+
+class OfflineSnapshot:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self._mmap.close()
+            raise ValueError('{} is not an offline data snapshot'.format(path))
+        self._has_precomputed_data = None
+
+    def _entry(self, index):
+        return struct.unpack_from(INDEX_ENTRY_FORMAT, self._mmap, HEADER_SIZE + index * INDEX_ENTRY_SIZE)
+
+    def _key(self, entry):
+        return self._mmap[entry[0]: entry[0] + entry[1]]
+
+    def lookup(self, container, command):
+        '''Binary search the sorted index and return the documents of the command'''
+        key = _generate_key(container, command)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            entry_key = self._key(entry)
+            if entry_key < key:
+                low = middle + 1
+            elif entry_key > key:
+                high = middle
+            else:
+                return json.loads(self._mmap[entry[2]: entry[2] + entry[3]])
+        return []
+
+    def has_precomputed_data(self):
+        '''Whether the snapshot has the precomputed recommendations matching the thresholds of the worker'''
+        if self._has_precomputed_data is None:
+            thresholds = self.lookup(SnapshotContainer.Metadata, 'thresholds')
+            self._has_precomputed_data = bool(thresholds) and thresholds == get_threshold_config()
+        return self._has_precomputed_data
+
+    def close(self):
+        self._mmap.close()
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_offline_snapshot():
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = OfflineSnapshot(os.environ["Offline_Snapshot_Path"])
+    return _snapshot
+
+
+def use_offline_snapshot():
+    return os.environ.get("Offline_Data_Source", "").lower() == "snapshot"
+
+
+def query_recommendation_from_snapshot(prev_command, recommend_type, error_info):
+    items = get_offline_snapshot().lookup(SnapshotContainer.Recommendation, prev_command)
+    return filter_snapshot_items(items, recommend_type, error_info)
+
+
+def query_recommendation_from_snapshot_2(pprev_command, prev_command, recommend_type, error_info):
+    items = get_offline_snapshot().lookup(SnapshotContainer.Recommendation_2, pprev_command + "|" + prev_command)
+    return filter_snapshot_items(items, recommend_type, error_info)
+
+
+def query_precomputed_recommendation(commands, cosmos_type, top_num):
+    '''Slice the precomputed recommendations of the latest commands, in the same order as the offline data service'''
+    snapshot = get_offline_snapshot()
+    entry = None
+    if len(commands) >= 2:
+        entry = snapshot.lookup(SnapshotContainer.Precomputed, _generate_precomputed_command(cosmos_type, commands[-2:]))
+    if not entry:
+        entry = snapshot.lookup(SnapshotContainer.Precomputed, _generate_precomputed_command(cosmos_type, commands[-1:]))
+    if not entry:
+        return []
+
+    # The items of the pair are followed by the ones of the last command, which are only used when the former are not enough
+    pair_count = entry['pair_count']
+    return entry['items'][0: top_num if pair_count >= top_num else pair_count + top_num]
+
+
+def filter_snapshot_items(items, recommend_type, error_info):
+    '''Apply the same conditions as `generated_query_kql` to the documents of the command'''
+    cosmos_types = get_cosmos_type_values(generated_cosmos_type(recommend_type, error_info))
+    error_info_arr = []
+    if error_info and need_error_info(recommend_type):
+        error_info_arr = [info.lower() for info in parse_error_info(error_info)]
+
+    result = []
+    for item in items:
+        if cosmos_types and item.get('type') not in cosmos_types:
+            continue
+        error_information = (item.get('errorInformation') or '').lower()
+        if any(info not in error_information for info in error_info_arr):
+            continue
+        result.append(item)
+    return result
+
+
+def _generate_key(container, command):
+    return (container + '\0' + command).encode('utf-8')
+
+
+def _generate_precomputed_command(cosmos_type, commands):
+    cosmos_type = ','.join(str(value) for value in get_cosmos_type_values(cosmos_type)) if not isinstance(cosmos_type, str) else cosmos_type
+    return cosmos_type + '\0' + '|'.join(commands)
+
+
+def get_threshold_config():
+    return {name: int(os.environ[name]) for name in ['Command_TotalCount_Threshold', 'Command_Ratio_Threshold',
+                                                     'Solution_TotalCount_Threshold', 'Solution_Ratio_Threshold']}
+
+
+def precompute_recommendations(documents, top_num):
+    '''Compute the offline recommendations of each command and pair of commands for the precomputed cosmos types
+
+    Args:
+        documents (dict): (container tag, command) -> list of documents
+        top_num (int): the max number of stored items of a command or pair of commands
+    '''
+    from .offline_data_service import build_recommend_items, get_thresholds
+    from .util import CosmosType
+
+    precomputed = {}
+    for cosmos_type in PRECOMPUTED_COSMOS_TYPES:
+        totalcount_threshold, ratio_threshold = get_thresholds(CosmosType.Solution if cosmos_type == '2' else CosmosType.Command)
+        recommend_type = RecommendType.Solution if cosmos_type == '2' else RecommendType.All if cosmos_type == '3,1' else RecommendType.Command
+
+        def _build(container_tag, commands):
+            items = filter_snapshot_items(copy.deepcopy(documents.get((container_tag, '|'.join(commands)), [])), recommend_type, None)
+            return build_recommend_items(items, commands, None, totalcount_threshold, ratio_threshold)[0: top_num]
+
+        for container_tag, command in documents:
+            if container_tag == SnapshotContainer.Recommendation:
+                items = _build(SnapshotContainer.Recommendation, [command])
+                pair_count = 0
+            elif container_tag == SnapshotContainer.Recommendation_2 and cosmos_type != '2':
+                # The solutions only depend on the last command
+                commands = command.split('|')
+                pair_items = _build(SnapshotContainer.Recommendation_2, commands)
+                items = pair_items + _build(SnapshotContainer.Recommendation, commands[-1:])
+                pair_count = len(pair_items)
+            else:
+                continue
+            if items:
+                precomputed[(SnapshotContainer.Precomputed, _generate_precomputed_command(cosmos_type, command.split('|')))] = \
+                    {'pair_count': pair_count, 'items': items}
+
+    precomputed[(SnapshotContainer.Metadata, 'thresholds')] = get_threshold_config()
+    return precomputed
+
+
+def write_snapshot(path, documents):
+    '''Write the snapshot file
+
+    Args:
+        path (str): path of the snapshot file
+        documents (dict): (container tag, command) -> list of documents
+    '''
+    entries = sorted((_generate_key(container, command), json.dumps(items, separators=(',', ':')).encode('utf-8'))
+                     for (container, command), items in documents.items())
+
+    data_offset = HEADER_SIZE + len(entries) * INDEX_ENTRY_SIZE
+    index = bytearray()
+    data = bytearray()
+    for key, value in entries:
+        key_offset = data_offset + len(data)
+        data.extend(key)
+        value_offset = data_offset + len(data)
+        data.extend(value)
+        index.extend(struct.pack(INDEX_ENTRY_FORMAT, key_offset, len(key), value_offset, len(value)))
+
+    # Replace the file atomically, the workers which have mapped the old file can keep reading it
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, len(entries)))
+        f.write(index)
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+async def export_snapshot(path):
+    '''Export the offline data containers in Cosmos into a snapshot file'''
+    from .cosmos_helper import get_container
+
+    documents = {}
+    for container_tag, container in [(SnapshotContainer.Recommendation, get_container("Recommendation_Container")),
+                                     (SnapshotContainer.Recommendation_2, get_container("Recommendation_Container_2"))]:
+        async for item in container.read_all_items():
+            item = {key: value for key, value in item.items() if not key.startswith('_')}
+            if 'nextCommand' in item:
+                item['nextCommand'] = sorted(item['nextCommand'], key=lambda x: int(x['count']), reverse=True)
+            documents.setdefault((container_tag, item['command']), []).append(item)
+    command_count = len(documents)
+
+    documents.update(precompute_recommendations(documents, int(os.environ.get("Offline_Precompute_Top", "50"))))
+    write_snapshot(path, documents)
+    return command_count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python -m RecommendationService.snapshot <snapshot path>')
+        sys.exit(1)
+    print('Exported {} commands into {}'.format(asyncio.run(export_snapshot(sys.argv[1])), sys.argv[1]))
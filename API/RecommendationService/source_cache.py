@@ -0,0 +1,33 @@
+import copy
+import os
+
+from shared_code.cache import StaleWhileRevalidateCache, is_revalidating
+from shared_code.diagnostics import detach_request_diagnostics, get_request_diagnostics
+
+
+# The results of the offline calculation and the knowledge base only depend on the latest commands, the type and the error,
+# so they are shared by all users. The results of Aladdin are personalized and must not be cached here.
+source_result_cache = StaleWhileRevalidateCache(max_size=int(os.environ.get("Source_Cache_Size", "4096")),
+                                                ttl=int(os.environ.get("Source_Cache_TTL", "60")),
+                                                stale_ttl=int(os.environ.get("Source_Cache_Stale_TTL", "600")))
+
+
+async def get_source_result(source, key, loader):
+    '''Get the result of the source from the cache, `loader` is called to load it on a miss or refresh it when it is stale'''
+
+    async def _load():
+        if is_revalidating():
+            # The background refresh outlives the request which triggered it
+            detach_request_diagnostics()
+        return await loader()
+
+    result, status = await source_result_cache.get_or_load((source,) + key, _load)
+    if status == 'disabled':
+        return result
+
+    diagnostics = get_request_diagnostics()
+    if diagnostics is not None:
+        diagnostics.record_cache_status(source, status)
+
+    # The callers fill extra fields into the returned items, so the cached items should not be shared with them
+    return copy.deepcopy(result)
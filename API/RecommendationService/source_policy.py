@@ -0,0 +1,134 @@
+'''Select the recommendation sources of a request by their adoption for the triggering command
+
+The adoption statistics are the per-command summaries of `az next` feedback in Docs/feedback_design.md, exported to a
+local file (`Source_Adoption_Stats_Path`, a JSON list or JSON lines of the summary documents). A source which was
+recommended at least `Source_Policy_Min_Recommendations` times for the command is skipped when its accuracy
+(adoption count / recommendation count) is under `Source_Policy_Skip_Rate`. Under `Source_Policy_Background_Rate`,
+the sources whose results fill the source cache run in the background: the response does not wait for them, and their
+cached results are used by the next requests of the command. The other sources would only spend backend calls whose
+results are rarely used, so they are skipped as well.
+
+A fraction of requests (`Source_Policy_Explore_Rate`) runs every source, so the skipped sources keep being recommended
+and their statistics stay up to date.
+'''
+import logging
+import os
+import random
+import threading
+from enum import Enum
+
+from shared_code.serialization import loads
+
+from .util import RecommendationSource
+
+
+class SourceDecision(str, Enum):
+    Run = 'run'
+    Background = 'background'
+    Skip = 'skip'
+
+
+# The prefixes of the adoption statistics of each source in the summary document.
+# The scenarios are recommended by the search, so the search uses the statistics of the scenario type.
+SOURCE_STATISTICS = {
+    RecommendationSource.KnowledgeBase: ('source_adoption', 'knowledgebase_'),
+    RecommendationSource.OfflineCaculation: ('source_adoption', 'caculation_'),
+    RecommendationSource.Aladdin: ('source_adoption', 'Aladdin_'),
+    RecommendationSource.Search: ('type_adoption', 'scenario_')
+}
+
+# The knowledge base is curated for the commands, so it is always queried
+ADAPTIVE_SOURCES = [RecommendationSource.OfflineCaculation, RecommendationSource.Aladdin, RecommendationSource.Search]
+# The sources whose results fill `source_cache`, only they can run in the background
+CACHED_SOURCES = [RecommendationSource.OfflineCaculation]
+
+
+class SourcePolicy:
+
+    def __init__(self, documents, min_recommendations=100, skip_rate=0.01, background_rate=0.03):
+        self.min_recommendations = min_recommendations
+        self.skip_rate = skip_rate
+        self.background_rate = background_rate
+        # Command -> {source: decision}, only the sources which do not run normally are kept
+        self.decisions = {}
+        for document in documents:
+            if not document.get('command'):
+                continue
+            decisions = {}
+            for source in ADAPTIVE_SOURCES:
+                decision = self.get_decision(*get_source_statistics(document, source))
+                if decision == SourceDecision.Background and source not in CACHED_SOURCES:
+                    decision = SourceDecision.Skip
+                if decision != SourceDecision.Run:
+                    decisions[source] = decision
+            if decisions:
+                self.decisions[document['command']] = decisions
+
+    def get_decision(self, rec_count, adoption_count):
+        # Without enough recommendations the adoption rate is not reliable
+        if rec_count < self.min_recommendations:
+            return SourceDecision.Run
+        accuracy = adoption_count / rec_count
+        if accuracy < self.skip_rate:
+            return SourceDecision.Skip
+        if accuracy < self.background_rate:
+            return SourceDecision.Background
+        return SourceDecision.Run
+
+    def get_source_decisions(self, command):
+        '''Get the decisions of the sources which should not run normally for the triggering command
+
+        Returns:
+            dict: RecommendationSource -> SourceDecision, the sources not in it run normally
+        '''
+        return self.decisions.get(command, {})
+
+
+def get_source_statistics(document, source):
+    '''Get (recommendation count, adoption count) of the source from a summary document'''
+    group, prefix = SOURCE_STATISTICS[source]
+    statistics = document.get(group) or {}
+    try:
+        return int(statistics.get(prefix + 'rec_count') or 0), int(statistics.get(prefix + 'adoption_count') or 0)
+    except (TypeError, ValueError):
+        return 0, 0
+
+
+def load_adoption_statistics(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.lstrip().startswith(b'['):
+        return loads(data)
+    return [loads(line) for line in data.splitlines() if line.strip()]
+
+
+_source_policy = None
+_source_policy_lock = threading.Lock()
+
+
+def use_adaptive_source_selection():
+    return os.environ.get("Adaptive_Source_Selection", "") == "1"
+
+
+def get_source_policy():
+    '''Lazily load the policy from the adoption statistics, one per worker'''
+    global _source_policy
+    if _source_policy is None:
+        with _source_policy_lock:
+            if _source_policy is None:
+                documents = load_adoption_statistics(os.environ["Source_Adoption_Stats_Path"])
+                _source_policy = SourcePolicy(documents,
+                                              min_recommendations=int(os.environ.get("Source_Policy_Min_Recommendations", "100")),
+                                              skip_rate=float(os.environ.get("Source_Policy_Skip_Rate", "0.01")),
+                                              background_rate=float(os.environ.get("Source_Policy_Background_Rate", "0.03")))
+                logging.info('Loaded the source policy of {} commands from {} adoption statistics'.format(len(_source_policy.decisions), len(documents)))
+    return _source_policy
+
+
+def get_source_decisions(session):
+    '''Get the decisions of the sources for the session, empty when the adaptive selection is disabled or explored'''
+    if not use_adaptive_source_selection() or not session.commands:
+        return {}
+    if random.random() < float(os.environ.get("Source_Policy_Explore_Rate", "0.05")):
+        return {}
+    return get_source_policy().get_source_decisions(session.commands[-1])
@@ -1,5 +1,5 @@
+import hashlib
 import re
-import json
 
 from enum import Enum
 
@@ -95,33 +95,61 @@ def parse_error_info(error_info):
     return error_info.split(split_str)
 
 
-def get_latest_cmd(command_list, num=1):
-    command_list_data = json.loads(command_list)
-    # If there is no command has been executed before, assume that the user's first command is "group create"
-    if len(command_list_data) == 0:
-        return "group create"
+def get_error_signature(recommend_type, error_info):
+    ''' The error fragments that take part in the query, used to identify the query result '''
+    if not error_info or not need_error_info(recommend_type):
+        return ''
+    return '|'.join(parse_error_info(error_info))
 
-    commands = []
-    for command_item in command_list_data:
-        cmd = json.loads(command_item)
-        commands.append(cmd['command'])
 
-    return commands[-num:]
+def generated_error_signature(error_info):
+    ''' Hash the template of the error, the values are stripped in the same way as `parse_error_info` '''
+    error_template = '|'.join(info.strip().lower() for info in parse_error_info(error_info))
+    if not error_template:
+        return ''
+    return hashlib.md5(error_template.encode('utf-8')).hexdigest()
 
 
-def generated_query_kql(command, recommend_type, error_info):
-    query = "SELECT * FROM c WHERE c.command = '{}' ".format(command)
+def generated_signature_query_kql(command, recommend_type, error_info):
+    ''' Generate the parameterized query matching the error signature exactly, it is used before the `CONTAINS` query '''
+    query = "SELECT * FROM c WHERE c.command = @command and c.errorSignature = @error_signature "
+    parameters = [{"name": "@command", "value": command},
+                  {"name": "@error_signature", "value": generated_error_signature(error_info)}]
 
-    cosmos_type =  generated_cosmos_type(recommend_type, error_info)
-    if isinstance(cosmos_type, str):
-        query += " and c.type in ({}) ".format(cosmos_type)
-    elif isinstance(cosmos_type, int):
-        query += " and c.type = {} ".format(cosmos_type)
+    cosmos_types = get_cosmos_type_values(generated_cosmos_type(recommend_type, error_info))
+    if cosmos_types:
+        query += " and c.type in ({}) ".format(", ".join(["@type" + str(index) for index in range(len(cosmos_types))]))
+        parameters.extend([{"name": "@type" + str(index), "value": value} for index, value in enumerate(cosmos_types)])
+    return query, parameters
+
+
+def generated_query_kql(command, recommend_type, error_info):
+    ''' Generate the parameterized query and its parameters '''
+    query = "SELECT * FROM c WHERE c.command = @command "
+    parameters = [{"name": "@command", "value": command}]
+
+    cosmos_types = get_cosmos_type_values(generated_cosmos_type(recommend_type, error_info))
+    if len(cosmos_types) > 1:
+        query += " and c.type in ({}) ".format(", ".join(["@type" + str(index) for index in range(len(cosmos_types))]))
+        parameters.extend([{"name": "@type" + str(index), "value": value} for index, value in enumerate(cosmos_types)])
+    elif cosmos_types:
+        query += " and c.type = @type "
+        parameters.append({"name": "@type", "value": cosmos_types[0]})
 
     # If there is an error message, recommend the solution first
     if error_info and need_error_info(recommend_type):
         error_info_arr = parse_error_info(error_info)
-        for info in error_info_arr:
-            query += " and CONTAINS(c.errorInformation, '{}', true) ".format(info)
+        for index, info in enumerate(error_info_arr):
+            query += " and CONTAINS(c.errorInformation, @error_info{}, true) ".format(index)
+            parameters.append({"name": "@error_info" + str(index), "value": info})
+
+    return query, parameters
 
-    return query
+
+def get_cosmos_type_values(cosmos_type):
+    ''' Convert the result of `generated_cosmos_type` into the list of type values stored in Cosmos '''
+    if isinstance(cosmos_type, str):
+        return [int(value) for value in cosmos_type.split(',')]
+    if isinstance(cosmos_type, int):
+        return [int(cosmos_type)]
+    return []
@@ -0,0 +1,68 @@
+'''Warm up a worker before it receives requests
+
+The clients of the backends are created and their connections opened, and the caches are filled with the
+recommendations of the hot commands in `Warmup_Commands`, a comma separated list ordered by popularity.
+An entry can also be the latest two commands joined by `|`, e.g. `vm create|vm show`, for the offline data of the pair.
+Only the first `Warmup_Top_Num` entries are warmed up.
+'''
+import asyncio
+import json
+import logging
+import os
+import time
+
+from .session import parse_command_list
+from .util import RecommendType
+
+
+def get_warmup_sessions():
+    entries = [entry.strip() for entry in os.environ.get("Warmup_Commands", "").split(',') if entry.strip()]
+    entries = entries[0: int(os.environ.get("Warmup_Top_Num", "20"))]
+    return [parse_command_list(json.dumps([json.dumps({'command': command.strip()}) for command in entry.split('|')]))
+            for entry in entries]
+
+
+async def warm_up(top_num=5):
+    '''Warm up the worker, the failures are logged and never raised
+
+    Args:
+        top_num (int, optional): `command_top_num` of the cached offline recommendations. Defaults to 5, the default of the requests.
+
+    Returns:
+        dict: duration and result of each step
+    '''
+    from .aladdin_service import get_aladdin_client
+    from .knowledge_base_service import get_recommend_from_knowledge_base
+    from .offline_data_service import get_recommend_from_offline_data
+    from .scenario_service import get_scenario_recommendation_from_search
+
+    sessions = get_warmup_sessions()
+    start = time.perf_counter()
+    summary = {'commands': len(sessions)}
+
+    async def _step(name, awaitable):
+        step_start = time.perf_counter()
+        try:
+            await awaitable
+            summary[name] = round((time.perf_counter() - step_start) * 1000, 2)
+        except Exception as e:  # pylint: disable=broad-except
+            summary[name] = repr(e)
+
+    async def _warm_up_session(session):
+        await get_recommend_from_knowledge_base(session, RecommendType.All, None)
+        await get_recommend_from_offline_data(session, RecommendType.All, None, top_num)
+
+    async def _open_aladdin_connection():
+        await get_aladdin_client().open_connection()
+
+    async def _open_search_connection():
+        # The first search creates the search client and opens its connection
+        if sessions:
+            await get_scenario_recommendation_from_search(sessions[0], top_num)
+
+    await asyncio.gather(_step('aladdin_connection_ms', _open_aladdin_connection()),
+                         _step('search_connection_ms', _open_search_connection()),
+                         _step('caches_ms', asyncio.gather(*[_warm_up_session(session) for session in sessions])))
+    summary['duration_ms'] = round((time.perf_counter() - start) * 1000, 2)
+    logging.info('Warmup: %s', json.dumps(summary))
+    return summary
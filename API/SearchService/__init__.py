@@ -1,15 +1,31 @@
-import json
+import asyncio
 import logging
+import os
 
 import azure.functions as func
+from shared_code.cache import TTLCache
+from shared_code.diagnostics import measure_async_stage, measure_stage, start_request_diagnostics
+from shared_code.serialization import encode_response
+
 from .src.exception import ParameterException
 from .src.search_service import get_search_results
 
 from .src.util import MatchRule, SearchScope, append_results, build_or_search_statement, build_search_statement, get_param_int, get_param_match_rule, get_param_search_scope, get_param_str
 
+# The fields of the search results used by the CLI. All fields of the index documents are returned by default, a request
+# asks for only some of them with `fields`, and the items of `commandSet` are then trimmed to the fields used by the CLI.
+SEARCH_RESULT_FIELDS = {
+    'scenario': None, 'description': None, 'source': None, 'source_url': None, 'score': None, 'highlights': None,
+    'commandSet': {'command': None, 'arguments': None, 'reason': None, 'example': None}
+}
+
+# CLI users search the same few phrases over and over, so the results of each keyword are cached in the worker
+search_cache = TTLCache(max_size=int(os.environ.get("Search_Cache_Size", "1024")),
+                        ttl=int(os.environ.get("Search_Cache_TTL", "300")))
+
 
-def main(req: func.HttpRequest,
-         context: func.Context) -> func.HttpResponse:
+async def main(req: func.HttpRequest,
+               context: func.Context) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
     try:
@@ -19,15 +35,51 @@ def main(req: func.HttpRequest,
         if top_num <=0 or top_num > 20:
             raise ParameterException("Illegal parameter: the parameter 'top_num' must be in the range 1-20")
         match_rule = get_param_match_rule(req, "match_rule", default=MatchRule.All)
+        fields = get_search_result_projection(get_param_str(req, "fields"))
     except ParameterException as e:
         return func.HttpResponse(e.msg, status_code=400)
-    results = get_search_results(build_search_statement(keyword, match_rule), top_num, search_scope.get_search_fields())
-    if len(keyword.split()) > 1 and len(results) < top_num and match_rule == MatchRule.All:
-        or_results = get_search_results(build_or_search_statement(keyword), top_num, search_scope.get_search_fields())
-        append_results(results, or_results)
-        results = results[:top_num]
-    return func.HttpResponse(json.dumps({
-        'data': results,
-        'error': None,
-        'status': 200
-    }), status_code=200)
+
+    diagnostics = start_request_diagnostics('SearchService')
+    cache_key = (tuple(keyword.split()), search_scope, top_num, match_rule)
+    results = search_cache.get(cache_key)
+    diagnostics.record_cache_status('search', 'miss' if results is None else 'hit')
+    if results is None:
+        results = await search(keyword, search_scope, top_num, match_rule)
+        search_cache.set(cache_key, results)
+
+    with measure_stage('serialize'):
+        body, mimetype, headers = encode_response(req, {
+            'data': results,
+            'error': None,
+            'status': 200
+        }, fields)
+    diagnostics.set_property('items', len(results))
+    diagnostics.set_property('response_bytes', len(body))
+    diagnostics.log()
+    headers.update(diagnostics.get_headers())
+    return func.HttpResponse(body, status_code=200, mimetype=mimetype, headers=headers)
+
+
+def get_search_result_projection(fields):
+    '''Get the projection of the search results keeping the comma separated fields, None keeps all fields'''
+    if not fields:
+        return None
+    return {name: SEARCH_RESULT_FIELDS.get(name) for name in (field.strip() for field in fields.split(',')) if name}
+
+
+async def search(keyword, search_scope, top_num, match_rule):
+    search_fields = search_scope.get_search_fields()
+    and_future = asyncio.ensure_future(measure_async_stage('search_and', get_search_results(build_search_statement(keyword, match_rule), top_num, search_fields)))
+    if len(keyword.split()) <= 1 or match_rule != MatchRule.All:
+        return await and_future
+
+    # The OR search is the fallback when the AND search has not enough results, it is sent at the same time to save a round trip
+    or_future = asyncio.ensure_future(measure_async_stage('search_or', get_search_results(build_or_search_statement(keyword), top_num, search_fields)))
+    try:
+        results = await and_future
+        if len(results) < top_num:
+            append_results(results, await or_future)
+            results = results[:top_num]
+        return results
+    finally:
+        or_future.cancel()
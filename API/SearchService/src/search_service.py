@@ -1,24 +1,39 @@
 from typing import List, Optional
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
+from shared_code.scenario_search import get_scenario_search_engine, use_embedded_search
 
 import os
+import threading
 
+_search_client = None
+_search_client_lock = threading.Lock()
 
-def get_search_results(search_statement: str, top: int = 5, search_fields: Optional[List[str]] = None):
-    service_endpoint = os.environ["SCENARIO_SEARCH_SERVICE_ENDPOINT"]
-    search_client = SearchClient(endpoint=service_endpoint,
-                                 index_name=os.environ["SCENARIO_SEARCH_INDEX"],
-                                 credential=AzureKeyCredential(os.environ["SCENARIO_SEARCH_SERVICE_SEARCH_KEY"]))
 
-    results = search_client.search(
-        search_text=search_statement,
-        include_total_count=True,
-        search_fields=search_fields,
-        highlight_fields=", ".join(search_fields) if search_fields else None,
-        top=top,
-        query_type='full')
-    results = list(results)
+def get_search_client():
+    """Lazily create one search client per worker and reuse it across invocations"""
+    global _search_client
+    if _search_client is None:
+        with _search_client_lock:
+            if _search_client is None:
+                from azure.core.credentials import AzureKeyCredential
+                from azure.search.documents.aio import SearchClient
+                _search_client = SearchClient(endpoint=os.environ["SCENARIO_SEARCH_SERVICE_ENDPOINT"],
+                                              index_name=os.environ["SCENARIO_SEARCH_INDEX"],
+                                              credential=AzureKeyCredential(os.environ["SCENARIO_SEARCH_SERVICE_SEARCH_KEY"]))
+    return _search_client
+
+
+async def get_search_results(search_statement: str, top: int = 5, search_fields: Optional[List[str]] = None):
+    if use_embedded_search():
+        results = get_scenario_search_engine().search(search_statement, top=top, search_fields=search_fields)
+    else:
+        results = await get_search_client().search(
+            search_text=search_statement,
+            include_total_count=True,
+            search_fields=search_fields,
+            highlight_fields=", ".join(search_fields) if search_fields else None,
+            top=top,
+            query_type='full')
+        results = [result async for result in results]
     for result in results:
         result.pop("rid")
         result["score"] = result.pop("@search.score")
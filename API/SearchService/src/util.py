@@ -135,6 +135,8 @@ def _build_search_statement(keyword: str, join_word=" AND ") -> str:
     return join_word.join(search_statement)
 
 def append_results(results, appended_results):
+    scenarios = {item["scenario"] for item in results}
     for result in appended_results:
-        if not next(filter(lambda item: item["scenario"] == result["scenario"], results), None):
+        if result["scenario"] not in scenarios:
+            scenarios.add(result["scenario"])
             results.append(result)
@@ -0,0 +1,9 @@
+import logging
+
+import azure.functions as func
+from RecommendationService.warmup import warm_up
+
+
+async def main(warmupContext: func.Context) -> None:
+    logging.info('Function App instance is warm.')
+    await warm_up()
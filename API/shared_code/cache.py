@@ -0,0 +1,162 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''Bounded in-process cache with per-entry TTL and LRU eviction'''
+
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expire_at, value = entry
+                if expire_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+_revalidating = contextvars.ContextVar('revalidating', default=False)
+
+
+def is_revalidating():
+    '''Whether the current task refreshes a stale entry, the caches below it should be bypassed then'''
+    return _revalidating.get()
+
+
+class StaleWhileRevalidateCache:
+    '''Bounded async cache which serves the stale entries immediately and refreshes them in the background
+
+    An entry is fresh within `ttl` seconds, then stale for `stale_ttl` more seconds and expired after that.
+    '''
+
+    def __init__(self, max_size=1024, ttl=60, stale_ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stats_counter = {'hit': 0, 'stale': 0, 'miss': 0, 'refresh_error': 0}
+        self._data = OrderedDict()
+        # key -> background refresh task, which also keeps the task referenced until it is done
+        self._refreshing = {}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    async def get_or_load(self, key, loader):
+        '''Get the value of the key and the cache status ("hit", "stale" or "miss")
+
+        Args:
+            key: hashable cache key
+            loader: function without arguments which returns an awaitable of the value
+        '''
+        if not self.enabled:
+            return await loader(), 'disabled'
+
+        now = time.monotonic()
+        entry = self._data.get(key)
+        if entry is not None:
+            loaded_at, value = entry
+            age = now - loaded_at
+            if age < self.ttl:
+                self._data.move_to_end(key)
+                self.stats_counter['hit'] += 1
+                return value, 'hit'
+            if age < self.ttl + self.stale_ttl:
+                self._data.move_to_end(key)
+                self.stats_counter['stale'] += 1
+                self._refresh(key, loader)
+                return value, 'stale'
+            del self._data[key]
+
+        self.stats_counter['miss'] += 1
+        value = await loader()
+        self.set(key, value)
+        return value, 'miss'
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def _refresh(self, key, loader):
+        if key in self._refreshing:
+            return
+
+        async def _load():
+            _revalidating.set(True)
+            return await loader()
+
+        task = asyncio.ensure_future(_load())
+        self._refreshing[key] = task
+        task.add_done_callback(lambda future: self._complete_refresh(key, future))
+
+    def _complete_refresh(self, key, future):
+        self._refreshing.pop(key, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # Keep serving the stale value until it expires, the next stale hit will retry
+            self.stats_counter['refresh_error'] += 1
+            logging.info('Failed to refresh the cached source result: {}'.format(repr(future.exception())))
+            return
+        self.set(key, future.result())
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'stale_ttl': self.stale_ttl,
+            'refreshing': len(self._refreshing),
+            **self.stats_counter
+        }
@@ -0,0 +1,161 @@
+'''Per-request stage timing, exposed as the `Server-Timing` header and a structured log line'''
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+
+_current_diagnostics = contextvars.ContextVar('current_diagnostics', default=None)
+
+
+class RequestDiagnostics:
+
+    def __init__(self, service, log_sampled=True, header_sampled=True):
+        self.service = service
+        self.log_sampled = log_sampled
+        self.header_sampled = header_sampled
+        self.start = time.perf_counter()
+        # stage -> {'duration_ms': total duration, 'calls': number of calls, 'items': number of returned items}
+        self.stages = {}
+        self.request_charge = 0.0
+        # cache -> {status: count}
+        self.cache_status = {}
+        self.properties = {}
+
+    def record_stage(self, stage, duration, items=None):
+        record = self.stages.setdefault(stage, {'duration_ms': 0.0, 'calls': 0})
+        record['duration_ms'] += duration * 1000
+        record['calls'] += 1
+        if items is not None:
+            record['items'] = record.get('items', 0) + items
+
+    @contextmanager
+    def stage(self, stage):
+        '''Time the block, the number of result items can be set through the yielded dict'''
+        result = {}
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            self.record_stage(stage, time.perf_counter() - start, result.get('items'))
+
+    def add_request_charge(self, request_charge):
+        self.request_charge += request_charge
+
+    def record_cache_status(self, cache, status):
+        statuses = self.cache_status.setdefault(cache, {})
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def merge(self, other):
+        '''Add the stages, request charge, cache statuses and list properties recorded by the diagnostics of a part of the request'''
+        for stage, record in other.stages.items():
+            merged = self.stages.setdefault(stage, {'duration_ms': 0.0, 'calls': 0})
+            merged['duration_ms'] += record['duration_ms']
+            merged['calls'] += record['calls']
+            if 'items' in record:
+                merged['items'] = merged.get('items', 0) + record['items']
+        self.request_charge += other.request_charge
+        for cache, statuses in other.cache_status.items():
+            for status, count in statuses.items():
+                merged_statuses = self.cache_status.setdefault(cache, {})
+                merged_statuses[status] = merged_statuses.get(status, 0) + count
+        for name, value in other.properties.items():
+            if isinstance(value, list):
+                self.properties.setdefault(name, []).extend(value)
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def get_total_duration(self):
+        return time.perf_counter() - self.start
+
+    def get_server_timing(self):
+        metrics = ['{};dur={:.1f}'.format(stage, record['duration_ms']) for stage, record in self.stages.items()]
+        metrics.append('total;dur={:.1f}'.format(self.get_total_duration() * 1000))
+        return ', '.join(metrics)
+
+    def get_headers(self):
+        if not self.header_sampled:
+            return {}
+        return {'Server-Timing': self.get_server_timing()}
+
+    def log(self):
+        if not self.log_sampled:
+            return
+        logging.info('RequestDiagnostics: %s', json.dumps({
+            'service': self.service,
+            'duration_ms': round(self.get_total_duration() * 1000, 2),
+            'request_charge': round(self.request_charge, 2),
+            'stages': {stage: dict(record, duration_ms=round(record['duration_ms'], 2)) for stage, record in self.stages.items()},
+            'cache': self.cache_status,
+            **self.properties
+        }, default=str))
+
+
+def _sampled(env_name):
+    return random.random() < float(os.environ.get(env_name, "1"))
+
+
+def start_request_diagnostics(service):
+    '''Create the diagnostics of the current request, the tasks created afterwards share it through the context'''
+    diagnostics = RequestDiagnostics(service,
+                                     log_sampled=_sampled("Diagnostics_Log_Sample_Rate"),
+                                     header_sampled=_sampled("Server_Timing_Sample_Rate"))
+    _current_diagnostics.set(diagnostics)
+    return diagnostics
+
+
+def start_child_diagnostics():
+    '''Record the current task apart from the request, e.g. a session of a batch request, so its request charge is its own
+
+    Returns:
+        RequestDiagnostics: the diagnostics of the task to be merged into the request by `RequestDiagnostics.merge`,
+        None when the request has no diagnostics
+    '''
+    parent = get_request_diagnostics()
+    if parent is None:
+        return None
+    child = RequestDiagnostics(parent.service, log_sampled=False, header_sampled=False)
+    _current_diagnostics.set(child)
+    return child
+
+
+def get_request_diagnostics():
+    return _current_diagnostics.get()
+
+
+def detach_request_diagnostics():
+    '''Stop recording into the diagnostics of the request in the current task, used by the background work the request started'''
+    _current_diagnostics.set(None)
+
+
+@contextmanager
+def measure_stage(stage):
+    '''Time a stage of the current request, it does nothing when there are no diagnostics'''
+    diagnostics = get_request_diagnostics()
+    if diagnostics is None:
+        yield {}
+        return
+    with diagnostics.stage(stage) as result:
+        yield result
+
+
+async def measure_async_stage(stage, awaitable):
+    '''Await the source and record its duration and number of items, including when it is cancelled'''
+    with measure_stage(stage) as result:
+        items = await awaitable
+        if isinstance(items, list):
+            result['items'] = len(items)
+        return items
+
+
+def record_request_charge(response_headers, _):
+    '''Used as the `response_hook` of Cosmos operations to collect the request charge of the current request'''
+    diagnostics = get_request_diagnostics()
+    if diagnostics is not None and response_headers:
+        try:
+            diagnostics.add_request_charge(float(response_headers.get('x-ms-request-charge', 0)))
+        except (TypeError, ValueError):
+            pass
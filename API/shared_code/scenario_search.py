@@ -0,0 +1,353 @@
+'''Embedded full-text search over the e2e scenarios, an alternative to the Cognitive Search index
+
+It answers the Lucene queries built by the services (terms, fuzzy terms like `word~1`, quoted phrases, AND, OR and
+parentheses) from an in-memory inverted index with BM25 scoring. The fuzzy terms are expanded through a BK-tree of
+the vocabulary with the optimal string alignment distance, like the edit distance of Lucene fuzzy queries.
+
+The corpus is loaded from a local JSON snapshot of the search index, which is the list of its documents.
+Export it from the index by running `python -m shared_code.scenario_search <path>` in the `API` folder,
+then set `Scenario_Search_Engine` to `embedded` and `Scenario_Search_Snapshot_Path` to the path.
+'''
+import copy
+import json
+import math
+import os
+import re
+import sys
+import threading
+
+SEARCH_FIELDS = ["name", "description", "commandSet/command"]
+# The gap between the values of a collection field, so that a phrase does not match across two commands
+POSITION_GAP = 100
+MAX_EDIT_DISTANCE = 2
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+_QUERY_TOKEN_PATTERN = re.compile(r'\s*(\(|\)|"[^"]*"|[^\s()"]+)')
+
+
+def tokenize(text):
+    return [token.lower() for token in _TOKEN_PATTERN.findall(text or '')]
+
+
+def get_field_values(document, field):
+    '''Get the text values of the field, `commandSet/command` is the sub field of a collection'''
+    if field == "commandSet/command":
+        return [item.get("command") or '' for item in document.get("commandSet") or []]
+    value = document.get(field)
+    return [value] if value else []
+
+
+def edit_distance(source, target, max_distance):
+    '''Optimal string alignment distance, or `max_distance + 1` when it is larger than `max_distance`'''
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    previous_row = None
+    row = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        previous_row, prev, row = row, previous_row, [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                row[j] = min(row[j], prev[j - 2] + 1)
+        if min(row) > max_distance:
+            return max_distance + 1
+    return row[-1]
+
+
+def load_snapshot_documents(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class BKTree:
+    '''Metric tree of the vocabulary to find the terms within an edit distance without comparing all of them'''
+
+    def __init__(self, words=()):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(word, node[0], sys.maxsize)
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        '''Get the (term, distance) pairs within `max_distance` of the word'''
+        result = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            term, children = nodes.pop()
+            # Compute the full distance, which bounds the distances of the children to search
+            distance = edit_distance(word, term, sys.maxsize)
+            if distance <= max_distance:
+                result.append((term, distance))
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return result
+
+
+class ScenarioSearchEngine:
+
+    def __init__(self, documents):
+        self.documents = documents
+        # field -> term -> {document index: [positions]}
+        self.postings = {field: {} for field in SEARCH_FIELDS}
+        # field -> [token count of each document]
+        self.field_lengths = {field: [0] * len(documents) for field in SEARCH_FIELDS}
+        for index, document in enumerate(documents):
+            for field in SEARCH_FIELDS:
+                position = 0
+                for value in get_field_values(document, field):
+                    tokens = tokenize(value)
+                    for offset, token in enumerate(tokens):
+                        self.postings[field].setdefault(token, {}).setdefault(index, []).append(position + offset)
+                    self.field_lengths[field][index] += len(tokens)
+                    position += len(tokens) + POSITION_GAP
+        self.average_lengths = {field: (sum(lengths) / len(lengths) if lengths else 0) or 1
+                                for field, lengths in self.field_lengths.items()}
+        self.vocabulary = BKTree(sorted({term for field_postings in self.postings.values() for term in field_postings}))
+        self._fuzzy_terms = {}
+        self._fuzzy_terms_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        return cls(load_snapshot_documents(path))
+
+    def search(self, search_text, top=5, search_fields=None):
+        '''Search the documents with the Lucene query, the results have the same format as the ones of Cognitive Search'''
+        fields = [field for field in search_fields or SEARCH_FIELDS if field in self.postings]
+        query = _QueryParser(search_text).parse()
+        if query is None:
+            return []
+
+        # document index -> (score, {field: matched terms})
+        matches = self._evaluate(query, fields)
+        ranked = sorted(matches.items(), key=lambda item: (-item[1][0], item[0]))[0: top]
+
+        results = []
+        for index, (score, matched_terms) in ranked:
+            result = copy.deepcopy(self.documents[index])
+            result['@search.score'] = score
+            result['@search.highlights'] = self._highlight(self.documents[index], matched_terms)
+            results.append(result)
+        return results
+
+    def _evaluate(self, query, fields):
+        operator, operands = query
+        if operator == 'term':
+            return self._match_term(operands[0], operands[1], fields)
+        if operator == 'phrase':
+            return self._match_phrase(operands, fields)
+
+        results = [self._evaluate(operand, fields) for operand in operands]
+        if operator == 'and':
+            indexes = set(results[0]).intersection(*results[1:])
+        else:
+            indexes = set().union(*results)
+        merged = {}
+        for index in indexes:
+            score = 0
+            matched_terms = {}
+            for result in results:
+                if index in result:
+                    score += result[index][0]
+                    for field, terms in result[index][1].items():
+                        matched_terms.setdefault(field, set()).update(terms)
+            merged[index] = (score, matched_terms)
+        return merged
+
+    def _get_fuzzy_terms(self, term, distance):
+        key = (term, distance)
+        terms = self._fuzzy_terms.get(key)
+        if terms is None:
+            terms = self.vocabulary.search(term, min(distance, MAX_EDIT_DISTANCE))
+            with self._fuzzy_terms_lock:
+                if len(self._fuzzy_terms) > 100000:
+                    self._fuzzy_terms.clear()
+                self._fuzzy_terms[key] = terms
+        return terms
+
+    def _bm25(self, field, index, term_frequency, document_frequency):
+        idf = math.log(1 + (len(self.documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        length_norm = 1 - BM25_B + BM25_B * self.field_lengths[field][index] / self.average_lengths[field]
+        return idf * term_frequency * (BM25_K1 + 1) / (term_frequency + BM25_K1 * length_norm)
+
+    def _match_term(self, text, distance, fields):
+        tokens = tokenize(text)
+        if len(tokens) != 1:
+            # The analyzer splits the term like `open-port` into a phrase
+            return self._match_phrase(tokens, fields)
+
+        expanded_terms = self._get_fuzzy_terms(tokens[0], distance) if distance else [(tokens[0], 0)]
+        result = {}
+        for field in fields:
+            field_scores = {}
+            for term, term_distance in expanded_terms:
+                postings = self.postings[field].get(term)
+                if not postings:
+                    continue
+                # The fuzzy matches are scored lower than the exact ones
+                boost = 1 - term_distance / (len(term) + 1)
+                for index, positions in postings.items():
+                    score = boost * self._bm25(field, index, len(positions), len(postings))
+                    if score > field_scores.get(index, (0, None))[0]:
+                        field_scores[index] = (score, term)
+            for index, (score, term) in field_scores.items():
+                previous_score, matched_terms = result.get(index, (0, {}))
+                matched_terms[field] = {term}
+                result[index] = (previous_score + score, matched_terms)
+        return result
+
+    def _match_phrase(self, tokens, fields):
+        tokens = [token for text in tokens for token in tokenize(text)]
+        if not tokens:
+            return {}
+        if len(tokens) == 1:
+            return self._match_term(tokens[0], 0, fields)
+
+        result = {}
+        for field in fields:
+            token_postings = [self.postings[field].get(token) for token in tokens]
+            if not all(token_postings):
+                continue
+            for index in set(token_postings[0]).intersection(*token_postings[1:]):
+                following_positions = [set(postings[index]) for postings in token_postings[1:]]
+                frequency = sum(1 for position in token_postings[0][index]
+                                if all(position + offset + 1 in positions for offset, positions in enumerate(following_positions)))
+                if not frequency:
+                    continue
+                score = sum(self._bm25(field, index, frequency, len(postings)) for postings in token_postings)
+                previous_score, matched_terms = result.get(index, (0, {}))
+                matched_terms[field] = set(tokens)
+                result[index] = (previous_score + score, matched_terms)
+        return result
+
+    def _highlight(self, document, matched_terms):
+        highlights = {}
+        for field, terms in matched_terms.items():
+            fragments = []
+            for value in get_field_values(document, field):
+                highlighted = _TOKEN_PATTERN.sub(lambda match: '<em>{}</em>'.format(match.group(0)) if match.group(0).lower() in terms else match.group(0), value)
+                if highlighted != value:
+                    fragments.append(highlighted)
+            if fragments:
+                highlights[field] = fragments
+        return highlights
+
+
+class _QueryParser:
+    '''Parse the Lucene query into nested (operator, operands) tuples
+
+    The operators are `and`, `or`, `term` with (text, edit distance) and `phrase` with the tokens.
+    The terms next to each other without an operator are combined with OR, like the search mode `any`.
+    '''
+
+    def __init__(self, search_text):
+        self.tokens = _QUERY_TOKEN_PATTERN.findall(search_text or '')
+        self.position = 0
+
+    def parse(self):
+        return self._parse_or()
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek() is not None and self._peek() != ')':
+            if self._peek() == 'OR':
+                self.position += 1
+            operands.append(self._parse_and())
+        operands = [operand for operand in operands if operand is not None]
+        if not operands:
+            return None
+        return operands[0] if len(operands) == 1 else ('or', operands)
+
+    def _parse_and(self):
+        operands = [self._parse_primary()]
+        while self._peek() == 'AND':
+            self.position += 1
+            operands.append(self._parse_primary())
+        operands = [operand for operand in operands if operand is not None]
+        if not operands:
+            return None
+        return operands[0] if len(operands) == 1 else ('and', operands)
+
+    def _parse_primary(self):
+        token = self._peek()
+        if token is None:
+            return None
+        self.position += 1
+        if token == '(':
+            query = self._parse_or()
+            if self._peek() == ')':
+                self.position += 1
+            return query
+        if token in (')', 'AND', 'OR'):
+            return None
+        if token.startswith('"'):
+            return ('phrase', tokenize(token.strip('"')))
+        text, _, distance = token.partition('~')
+        try:
+            distance = int(distance) if distance else 0
+        except ValueError:
+            distance = MAX_EDIT_DISTANCE
+        return ('term', (text, distance))
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def use_embedded_search():
+    return os.environ.get("Scenario_Search_Engine", "").lower() == "embedded"
+
+
+def get_scenario_search_engine():
+    '''Lazily load the search engine from the snapshot, one per worker'''
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = ScenarioSearchEngine.load(os.environ["Scenario_Search_Snapshot_Path"])
+    return _engine
+
+
+def export_snapshot(path):
+    '''Export all documents of the Cognitive Search index into the snapshot file'''
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents import SearchClient
+
+    client = SearchClient(endpoint=os.environ["SCENARIO_SEARCH_SERVICE_ENDPOINT"],
+                          index_name=os.environ["SCENARIO_SEARCH_INDEX"],
+                          credential=AzureKeyCredential(os.environ["SCENARIO_SEARCH_SERVICE_SEARCH_KEY"]))
+    documents = [{key: value for key, value in result.items() if not key.startswith('@search.')}
+                 for result in client.search(search_text='*')]
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(documents, f)
+    os.replace(temp_path, path)
+    return len(documents)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python -m shared_code.scenario_search <snapshot path>')
+        sys.exit(1)
+    print('Exported {} scenarios into {}'.format(export_snapshot(sys.argv[1]), sys.argv[1]))
@@ -0,0 +1,121 @@
+'''JSON encoding and decoding, using orjson when it is installed, and the encoding of the responses'''
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def loads(data):
+    '''Decode JSON from str or bytes'''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    '''Encode obj as compact JSON bytes'''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def project(value, fields):
+    '''Keep only the given fields of the dicts in value
+
+    Args:
+        value: a dict, or a list of the values to project
+        fields (dict): field name -> projection of the field value, None keeps the whole value
+
+    Returns:
+        the projected copy of value, the dicts are projected recursively and the other values are shared
+    '''
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: item if fields[key] is None else project(item, fields[key])
+                for key, item in value.items() if key in fields}
+    return value
+
+
+def use_field_projection():
+    return os.environ.get("Response_Field_Projection", "1") == "1"
+
+
+def encode_response(req, response_data, fields=None):
+    '''Encode the response data in the format accepted by the request
+
+    The data is encoded as MessagePack when `Accept` asks for it with a non-zero quality not lower than JSON and msgpack
+    is installed, otherwise as JSON. The body is compressed by gzip when `Accept-Encoding` allows it with a non-zero
+    quality and it is larger than `Response_Gzip_Min_Size`.
+
+    Args:
+        req (func.HttpRequest): the request with the `Accept` and `Accept-Encoding` headers
+        response_data (dict): the response data
+        fields (dict, optional): the projection of `response_data['data']`, see `project`
+
+    Returns:
+        tuple: (body, mimetype, headers)
+    '''
+    if fields is not None and use_field_projection() and response_data.get('data'):
+        response_data = dict(response_data, data=project(response_data['data'], fields))
+
+    accept = _parse_quality_values(_get_header(req, 'Accept'))
+    # MessagePack is only used when it is asked explicitly with a quality not lower than JSON
+    msgpack_quality = max(accept.get(mimetype, 0.0) for mimetype in MSGPACK_MIMETYPES)
+    if msgpack is not None and msgpack_quality > 0 and msgpack_quality >= _get_quality(accept, 'application/json', 'application/*', '*/*'):
+        # Without `strict_types` the `int` and `str` enums of the items are packed as their plain values, like in JSON
+        body = msgpack.packb(response_data, use_bin_type=True)
+        mimetype = 'application/msgpack'
+    else:
+        body = dumps(response_data)
+        mimetype = 'application/json'
+
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    accept_encoding = _parse_quality_values(_get_header(req, 'Accept-Encoding'))
+    if _get_quality(accept_encoding, 'gzip', '*') > 0 and len(body) >= int(os.environ.get("Response_Gzip_Min_Size", "1024")):
+        body = gzip.compress(body, compresslevel=int(os.environ.get("Response_Gzip_Level", "5")))
+        headers['Content-Encoding'] = 'gzip'
+    return body, mimetype, headers
+
+
+def _parse_quality_values(header):
+    '''Parse an `Accept` or `Accept-Encoding` header as {value: quality}, the values without `q` have the quality 1'''
+    qualities = {}
+    for part in header.split(','):
+        value, *params = [token.strip() for token in part.split(';')]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = min(max(float(param_value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        qualities[value] = max(quality, qualities.get(value, 0.0))
+    return qualities
+
+
+def _get_quality(qualities, *values):
+    '''The quality of the first of values in the parsed header, from the most to the least specific'''
+    for value in values:
+        if value in qualities:
+            return qualities[value]
+    return 0.0
+
+
+def _get_header(req, name):
+    return (req.headers.get(name) or '').lower() if req is not None and req.headers else ''
@@ -0,0 +1,240 @@
+'''In-process stand-ins for Cosmos DB, Aladdin and Cognitive Search
+
+Every fake sleeps for a latency drawn from a log-normal distribution and fails with a configured probability,
+so the benchmark can reproduce slow or flaky backends without any network access.
+'''
+import asyncio
+import json
+import math
+import random
+
+import aiohttp
+from azure.core.exceptions import HttpResponseError
+from azure.cosmos.exceptions import CosmosHttpResponseError
+
+from workload import COMMAND_TRANSITIONS, ERROR_MESSAGES, get_all_commands
+
+
+class LatencyModel:
+    '''Log-normal latency with the given median (ms) and a failure probability'''
+
+    def __init__(self, median_ms=5.0, sigma=0.5, failure_rate=0.0, seed=0):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+    def sample(self):
+        if self.median_ms <= 0:
+            return 0
+        return self.median_ms * math.exp(self.random.gauss(0, self.sigma)) / 1000
+
+    def should_fail(self):
+        return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+
+def generate_cosmos_data():
+    '''Generate the documents of each container from the transition graph of the workload'''
+    # The error signatures are set like `RecommendationService.error_signature` does at ingest
+    from RecommendationService.util import generated_error_signature
+
+    commands = get_all_commands()
+    recommendation, recommendation_2, knowledge_base, e2e_scenario = [], [], [], []
+
+    def _next_commands(command):
+        next_commands = COMMAND_TRANSITIONS.get(command) or COMMAND_TRANSITIONS['group create']
+        return [{'command': next_command, 'arguments': ['--name', '--resource-group'], 'count': str(1000 // (index + 1)),
+                 'reason': 'Frequently used after {}'.format(command)} for index, next_command in enumerate(next_commands)]
+
+    for command in commands:
+        next_commands = _next_commands(command)
+        recommendation.append({'id': command, 'command': command, 'type': 1,
+                               'totalCount': sum(int(item['count']) for item in next_commands), 'nextCommand': next_commands})
+        knowledge_base.append({'id': command, 'command': command, 'type': 1, 'nextCommand': next_commands[:1]})
+        for error_message in ERROR_MESSAGES:
+            knowledge_base.append({'id': command + error_message, 'command': command, 'type': 2, 'errorInformation': error_message,
+                                   'errorSignature': generated_error_signature(error_message),
+                                   'nextCommand': [{'command': command, 'arguments': ['--location'], 'reason': 'Fix the error'}]})
+        for next_command in next_commands:
+            bigram = command + '|' + next_command['command']
+            bigram_next = _next_commands(next_command['command'])
+            recommendation_2.append({'id': bigram, 'command': bigram, 'type': 1,
+                                     'totalCount': sum(int(item['count']) for item in bigram_next), 'nextCommand': bigram_next})
+
+    for command, next_commands in COMMAND_TRANSITIONS.items():
+        e2e_scenario.append(generate_scenario(command, next_commands))
+    return {'recommendation': recommendation, 'recommendation_2': recommendation_2,
+            'knowledge_base': knowledge_base, 'e2e_scenario': e2e_scenario}
+
+
+def generate_scenario(command, next_commands):
+    command_set = [{'command': 'az ' + item, 'arguments': ['--name', '--resource-group'], 'reason': 'Run ' + item,
+                    'example': 'az {} --name $name --resource-group $rg'.format(item)} for item in [command] + next_commands[:4]]
+    return {'id': 'Scenario of ' + command, 'name': 'Scenario of ' + command, 'firstCommand': 'az ' + command,
+            'description': 'Create resources starting with az ' + command, 'commandSet': command_set, 'source': 1,
+            'source_url': 'https://example.com/' + command.replace(' ', '-'), 'update_time': '2022-07-12T03:58:55'}
+
+
+def _match_document(document, parameters):
+    values = {parameter['name']: parameter['value'] for parameter in parameters or []}
+    if '@command' in values and document.get('command') != values['@command']:
+        return False
+    if '@cmd' in values and document.get('firstCommand') != values['@cmd']:
+        return False
+    if '@error_signature' in values and document.get('errorSignature') != values['@error_signature']:
+        return False
+    types = [value for name, value in values.items() if name.startswith('@type')]
+    if types and document.get('type') not in types:
+        return False
+    error_information = (document.get('errorInformation') or '').lower()
+    for name, value in values.items():
+        if name.startswith('@error_info') and value.lower() not in error_information:
+            return False
+    return True
+
+
+class FakeAsyncItemPaged:
+
+    def __init__(self, items, latency):
+        self.items = items
+        self.latency = latency
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await asyncio.sleep(self.latency)
+        for item in self.items:
+            yield item
+
+
+class FakeContainer:
+
+    def __init__(self, container_id, documents, latency_model, request_charge=2.8):
+        self.id = container_id
+        self.documents = documents
+        self.latency_model = latency_model
+        self.request_charge = request_charge
+        self.query_count = 0
+
+    def _call_hook(self, kwargs, result):
+        if kwargs.get('response_hook'):
+            kwargs['response_hook']({'x-ms-request-charge': str(self.request_charge), 'x-ms-documentdb-partitionkeyrangeid': '0'}, result)
+
+    def _check_failure(self):
+        if self.latency_model.should_fail():
+            raise CosmosHttpResponseError(status_code=503, message='Fake Cosmos failure')
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        self.query_count += 1
+        self._check_failure()
+        items = [json.loads(json.dumps(document)) for document in self.documents if _match_document(document, parameters)]
+        self._call_hook(kwargs, items)
+        return FakeAsyncItemPaged(items, self.latency_model.sample())
+
+    def read_all_items(self, **kwargs):
+        return FakeAsyncItemPaged(list(self.documents), self.latency_model.sample())
+
+    async def upsert_item(self, body, **kwargs):
+        self.query_count += 1
+        await asyncio.sleep(self.latency_model.sample())
+        self.documents = [document for document in self.documents if document.get('id') != body['id']] + [body]
+        return body
+
+
+class FakeDatabase:
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def get_container_client(self, container):
+        return self.containers[container]
+
+
+class FakeCosmosClient:
+    '''Replacement of `azure.cosmos.aio.CosmosClient`, the containers are registered by `install_fake_cosmos`'''
+    containers = {}
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_database_client(self, database):
+        return FakeDatabase(self.containers)
+
+
+def install_fake_cosmos(container_names, latency_model):
+    '''Register the fake containers under the container names from the environment variables
+
+    Args:
+        container_names (dict): data key of `generate_cosmos_data` -> container name
+    '''
+    import azure.cosmos.aio
+    # Register the containers before generating the data, which imports RecommendationService and gets the containers
+    FakeCosmosClient.containers = {name: FakeContainer(name, [], latency_model) for name in container_names.values()}
+    azure.cosmos.aio.CosmosClient = FakeCosmosClient
+    data = generate_cosmos_data()
+    for key, name in container_names.items():
+        FakeCosmosClient.containers[name].documents = data[key]
+    return FakeCosmosClient.containers
+
+
+class FakeAladdinClient:
+    '''Replacement of the client returned by `aladdin_service.get_aladdin_client`'''
+
+    def __init__(self, latency_model):
+        self.latency_model = latency_model
+        self.metrics = {'requests': 0, 'errors': 0, 'timeouts': 0, 'hedged': 0}
+
+    async def post(self, data, headers):
+        self.metrics['requests'] += 1
+        await asyncio.sleep(self.latency_model.sample())
+        if self.latency_model.should_fail():
+            self.metrics['errors'] += 1
+            raise aiohttp.ClientError('Fake Aladdin failure')
+        history = json.loads(data)['history']
+        last_command = history[-1].split(' -')[0].split(' ***')[0]
+        next_commands = COMMAND_TRANSITIONS.get(last_command) or COMMAND_TRANSITIONS['group create']
+        predictions = [{'command': '{} --name <name> --resource-group <rg>'.format(command), 'score': 1 - index / 10,
+                        'description': 'Predicted by the fake Aladdin'} for index, command in enumerate(next_commands)]
+        return 200, 'OK', json.dumps(predictions)
+
+    async def open_connection(self):
+        await asyncio.sleep(self.latency_model.sample())
+        return 200
+
+    async def close(self):
+        pass
+
+
+def _search_scenarios(scenarios, search_text, top):
+    words = [word.strip('"()~12').lower() for word in search_text.replace('"', ' ').split()]
+    words = [word for word in words if word and word not in ('and', 'or')]
+    results = []
+    for scenario in scenarios:
+        content = ' '.join([scenario['name'], scenario['description']] + [item['command'] for item in scenario['commandSet']]).lower()
+        score = sum(content.count(word) for word in words)
+        if score:
+            result = dict(scenario, rid=scenario['id'])
+            result['@search.score'] = float(score)
+            result['@search.highlights'] = {'commandSet/command': ['<em>{}</em>'.format(scenario['firstCommand'])]}
+            results.append(result)
+    results.sort(key=lambda item: item['@search.score'], reverse=True)
+    return results[:top]
+
+
+class FakeSearchClient:
+    '''Replacement of the async `SearchClient` used by both services'''
+    latency_model = LatencyModel()
+    scenarios = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def search(self, search_text, top=5, **kwargs):
+        await asyncio.sleep(self.latency_model.sample())
+        if self.latency_model.should_fail():
+            raise HttpResponseError(message='Fake search failure')
+        return FakeAsyncItemPaged(_search_scenarios(self.scenarios, search_text, top), 0)
+
+    async def close(self):
+        pass
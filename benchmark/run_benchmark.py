@@ -0,0 +1,323 @@
+'''Benchmark of RecommendationService and SearchService with local stand-ins of the backends
+
+Usage (from the root of the repository, with the packages in API/requirements.txt installed):
+
+    python benchmark/run_benchmark.py --service recommendation --requests 2000 --concurrency 32
+    python benchmark/run_benchmark.py --service search --requests 500 --search-latency 20 --failure-rate 0.01
+    python benchmark/run_benchmark.py --service search --env Scenario_Search_Engine=embedded --env Search_Cache_Size=0
+    python benchmark/run_benchmark.py --accept application/msgpack --accept-encoding gzip
+
+The report contains p50/p95/p99 latency and throughput of the requests and each stage, and with `--allocations`
+the memory allocated by each stage (measured with tracemalloc, run with `--concurrency 1` for exact attribution).
+'''
+import argparse
+import asyncio
+import functools
+import gzip
+import importlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'API')
+sys.path.insert(0, API_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+DEFAULT_ENVIRONMENT = {
+    'CosmosDB_Endpoint': 'https://localhost:8081',
+    'CosmosDB_Key': 'ZmFrZQ==',
+    'CosmosDB_DataBase': 'benchmark',
+    'KnowledgeBase_Container': 'knowledge_base',
+    'Recommendation_Container': 'recommendation',
+    'Recommendation_Container_2': 'recommendation_2',
+    'E2EScenario_Container': 'e2e_scenario',
+    'Aladdin_Service_URL': 'http://localhost/aladdin',
+    'Aladdin_History_Command': '0',
+    'Support_Personalization': '1',
+    'Recommendation_Prefer': '1',
+    'Solution_TotalCount_Threshold': '1',
+    'Solution_Ratio_Threshold': '1',
+    'Command_TotalCount_Threshold': '1',
+    'Command_Ratio_Threshold': '1',
+    'SCENARIO_SEARCH_SERVICE_ENDPOINT': 'https://localhost/search',
+    'SCENARIO_SEARCH_INDEX': 'scenario',
+    'SCENARIO_SEARCH_SERVICE_SEARCH_KEY': 'fake',
+}
+
+
+class StageRecorder:
+
+    def __init__(self, trace_allocations=False):
+        self.durations = defaultdict(list)
+        self.allocations = defaultdict(int)
+        self.trace_allocations = trace_allocations
+
+    def _start(self):
+        return time.perf_counter(), tracemalloc.get_traced_memory()[0] if self.trace_allocations else 0
+
+    def _stop(self, stage, start):
+        self.durations[stage].append(time.perf_counter() - start[0])
+        if self.trace_allocations:
+            self.allocations[stage] += max(tracemalloc.get_traced_memory()[0] - start[1], 0)
+
+    def wrap(self, stage, function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def _async_wrapper(*args, **kwargs):
+                start = self._start()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self._stop(stage, start)
+            return _async_wrapper
+
+        @functools.wraps(function)
+        def _wrapper(*args, **kwargs):
+            start = self._start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._stop(stage, start)
+        return _wrapper
+
+    def patch(self, module, name, stage=None):
+        setattr(module, name, self.wrap(stage or name, getattr(module, name)))
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(durations, elapsed, allocations=None, request_count=None):
+    report = {}
+    for stage, values in durations.items():
+        report[stage] = {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p95_ms': round(percentile(values, 95) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'mean_ms': round(statistics.mean(values) * 1000, 3),
+            'throughput_per_s': round(len(values) / elapsed, 1) if elapsed else 0,
+        }
+        if allocations is not None and request_count:
+            report[stage]['allocated_bytes_per_request'] = allocations.get(stage, 0) // request_count
+    return report
+
+
+def print_report(report):
+    columns = ['count', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'throughput_per_s', 'allocated_bytes_per_request']
+    columns = [column for column in columns if any(column in values for values in report.values())]
+    print('{:<28}'.format('stage') + ''.join('{:>30}'.format(column) for column in columns))
+    for stage, values in report.items():
+        print('{:<28}'.format(stage) + ''.join('{:>30}'.format(values.get(column, '')) for column in columns))
+
+
+def setup_environment(args):
+    for key, value in DEFAULT_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    for item in args.env or []:
+        key, value = item.split('=', 1)
+        os.environ[key] = value
+
+
+def install_fakes(args):
+    import fakes
+
+    cosmos_latency = fakes.LatencyModel(args.cosmos_latency, args.latency_sigma, args.failure_rate, args.seed)
+    containers = fakes.install_fake_cosmos({
+        'recommendation': os.environ['Recommendation_Container'],
+        'recommendation_2': os.environ['Recommendation_Container_2'],
+        'knowledge_base': os.environ['KnowledgeBase_Container'],
+        'e2e_scenario': os.environ['E2EScenario_Container'],
+    }, cosmos_latency)
+
+    fakes.FakeSearchClient.latency_model = fakes.LatencyModel(args.search_latency, args.latency_sigma, args.failure_rate, args.seed + 1)
+    fakes.FakeSearchClient.scenarios = containers[os.environ['E2EScenario_Container']].documents
+    # The services import the search client when they create it
+    import azure.search.documents.aio
+    azure.search.documents.aio.SearchClient = fakes.FakeSearchClient
+    if os.environ.get('Scenario_Search_Engine', '').lower() == 'embedded' and not os.environ.get('Scenario_Search_Snapshot_Path'):
+        # Serve the embedded search engine from the scenarios of the fake index
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump([dict(scenario, rid=scenario['id']) for scenario in fakes.FakeSearchClient.scenarios], f)
+        os.environ['Scenario_Search_Snapshot_Path'] = f.name
+    return fakes, containers
+
+
+def decode_response(response):
+    '''Decode the body of a response by its Content-Encoding and mimetype, so the encodings are checked by the benchmark'''
+    from shared_code.serialization import loads
+
+    body = response.get_body()
+    if response.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    if response.mimetype == 'application/msgpack':
+        import msgpack
+        return msgpack.unpackb(body, raw=False)
+    return loads(body)
+
+
+async def run_requests(main, requests, concurrency, recorder, headers=None):
+    import azure.functions as func
+
+    semaphore = asyncio.Semaphore(concurrency)
+    status_codes = defaultdict(int)
+
+    async def _run(request):
+        async with semaphore:
+            http_request = func.HttpRequest(method='POST', url='/api/benchmark', headers=dict(headers or {}, **{'Content-Type': 'application/json'}),
+                                            params={}, body=json.dumps(request).encode('utf-8'))
+            start = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(main):
+                    response = await main(http_request)
+                else:
+                    # The synchronous functions are run in the thread pool by the Functions host
+                    response = await asyncio.get_running_loop().run_in_executor(None, main, http_request)
+                status_codes[response.status_code] += 1
+                # The bodies which do not decode to the response data with the same status are counted as `undecodable`
+                if response.status_code == 200 and response.mimetype != 'text/plain':
+                    data = decode_response(response)
+                    if not isinstance(data, dict) or data.get('status') != response.status_code:
+                        status_codes['undecodable'] += 1
+            except Exception:  # pylint: disable=broad-except
+                status_codes['exception'] += 1
+            recorder.durations['request'].append(time.perf_counter() - start)
+
+    await asyncio.gather(*[_run(request) for request in requests])
+    return dict(status_codes)
+
+
+def import_service(name):
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    return module, time.perf_counter() - start
+
+
+def benchmark_recommendation(args, recorder, generator):
+    # The service is imported before the fakes, which import it to generate the data
+    RecommendationService, import_duration = import_service('RecommendationService')
+    fakes, containers = install_fakes(args)
+    from RecommendationService import (aladdin_service, knowledge_base_service, offline_data_service, personalized_analysis,
+                                       scenario_service)
+
+    aladdin_service._aladdin_client = fakes.FakeAladdinClient(
+        fakes.LatencyModel(args.aladdin_latency, args.latency_sigma, args.failure_rate, args.seed + 2))
+
+    for module, name, stage in [(knowledge_base_service, 'get_recommend_from_knowledge_base', 'knowledge_base'),
+                                (offline_data_service, 'get_recommend_from_offline_data', 'offline_data'),
+                                (aladdin_service, 'get_recommend_from_aladdin', 'aladdin'),
+                                (scenario_service, 'get_scenario_recommendation_from_search', 'scenario_search'),
+                                (RecommendationService, 'fuse_recommendation_items', 'fusion'),
+                                (personalized_analysis, 'analyze_personal_path', 'personalization'),
+                                (RecommendationService, 'filter_recommendation_result', 'filter')]:
+        recorder.patch(module, name, stage)
+
+    requests = [generator.generate_recommendation_request() for _ in range(args.requests)]
+    return RecommendationService.main, requests, containers, import_duration
+
+
+def benchmark_search(args, recorder, generator):
+    SearchService, import_duration = import_service('SearchService')
+    fakes, containers = install_fakes(args)
+
+    recorder.patch(SearchService, 'get_search_results', 'search')
+
+    requests = [generator.generate_search_request() for _ in range(args.requests)]
+    # The function context is not used by SearchService
+    return functools.partial(SearchService.main, context=None), requests, containers, import_duration
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the services with local stand-ins of the backends')
+    parser.add_argument('--service', choices=['recommendation', 'search'], default='recommendation')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=50, help='requests sent before measuring')
+    parser.add_argument('--warm-up', action='store_true', help='run the warm-up of RecommendationService with Warmup_Commands first')
+    parser.add_argument('--cosmos-latency', type=float, default=5, help='median latency of Cosmos in ms')
+    parser.add_argument('--aladdin-latency', type=float, default=30, help='median latency of Aladdin in ms')
+    parser.add_argument('--search-latency', type=float, default=40, help='median latency of Cognitive Search in ms')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='sigma of the log-normal latency distribution')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability that a backend call fails')
+    parser.add_argument('--max-history', type=int, default=10, help='max length of the generated command histories')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--allocations', action='store_true', help='trace the memory allocated by each stage')
+    parser.add_argument('--env', action='append', help='extra environment variable in the format of KEY=VALUE')
+    parser.add_argument('--output', help='write the report into a JSON file')
+    parser.add_argument('--accept', help='Accept header of the requests, e.g. application/msgpack')
+    parser.add_argument('--accept-encoding', help='Accept-Encoding header of the requests, e.g. gzip')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup_environment(args)
+
+    from workload import WorkloadGenerator
+    generator = WorkloadGenerator(seed=args.seed, max_history=args.max_history)
+    recorder = StageRecorder(trace_allocations=args.allocations)
+
+    if args.service == 'recommendation':
+        service_main, requests, containers, import_duration = benchmark_recommendation(args, recorder, generator)
+    else:
+        service_main, requests, containers, import_duration = benchmark_search(args, recorder, generator)
+
+    headers = {name: value for name, value in [('Accept', args.accept), ('Accept-Encoding', args.accept_encoding)] if value}
+
+    async def _run():
+        if args.warm_up:
+            from RecommendationService.warmup import warm_up
+            await warm_up()
+        # The first request pays for the lazy initialization of the clients
+        await run_requests(service_main, requests[:1], 1, recorder, headers)
+        first_request_duration = recorder.durations['request'][0]
+        await run_requests(service_main, requests[:args.warmup], args.concurrency, recorder, headers)
+        recorder.durations.clear()
+        recorder.allocations.clear()
+        for container in containers.values():
+            container.query_count = 0
+        if args.allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        status_codes = await run_requests(service_main, requests, args.concurrency, recorder, headers)
+        elapsed = time.perf_counter() - start
+        if args.allocations:
+            tracemalloc.stop()
+        return status_codes, elapsed, first_request_duration
+
+    status_codes, elapsed, first_request_duration = asyncio.run(_run())
+
+    report = {
+        'service': args.service,
+        'requests': len(requests),
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(requests) / elapsed, 1),
+        'status_codes': status_codes,
+        'import_ms': round(import_duration * 1000, 3),
+        'first_request_ms': round(first_request_duration * 1000, 3),
+        'cosmos_queries': {name: container.query_count for name, container in containers.items()},
+        'stages': summarize(recorder.durations, elapsed, recorder.allocations if args.allocations else None, len(requests)),
+    }
+    print('{} requests in {}s ({} req/s), status codes: {}'.format(report['requests'], report['elapsed_s'],
+                                                                   report['throughput_per_s'], status_codes))
+    print('Import: {}ms, first request: {}ms'.format(report['import_ms'], report['first_request_ms']))
+    print('Cosmos queries: {}'.format(report['cosmos_queries']))
+    print_report(report['stages'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''Workload generator for the benchmark
+
+Command histories are random walks over a small transition graph of popular commands, so a few hot commands
+make up most of the traffic like the production workload.
+'''
+import json
+import random
+
+COMMAND_TRANSITIONS = {
+    'group create': ['vm create', 'webapp create', 'storage account create', 'appservice plan create', 'network vnet create',
+                     'aks create', 'sql server create', 'keyvault create', 'cosmosdb create', 'acr create'],
+    'vm create': ['vm show', 'vm list', 'vm open-port', 'vm start', 'vm stop', 'network nsg rule create', 'vm extension set'],
+    'webapp create': ['webapp config appsettings set', 'webapp deployment source config', 'webapp show', 'webapp log tail', 'webapp browse'],
+    'appservice plan create': ['webapp create', 'appservice plan show', 'functionapp create'],
+    'storage account create': ['storage container create', 'storage account keys list', 'storage blob upload', 'storage account show'],
+    'storage container create': ['storage blob upload', 'storage blob list', 'storage container list'],
+    'network vnet create': ['network vnet subnet create', 'network nsg create', 'network public-ip create', 'vm create'],
+    'aks create': ['aks get-credentials', 'aks show', 'aks scale', 'acr create'],
+    'sql server create': ['sql db create', 'sql server firewall-rule create', 'sql server show'],
+    'keyvault create': ['keyvault secret set', 'keyvault set-policy', 'keyvault show'],
+    'cosmosdb create': ['cosmosdb sql database create', 'cosmosdb keys list', 'cosmosdb show'],
+    'acr create': ['acr login', 'acr build', 'aks update'],
+}
+
+ERROR_MESSAGES = [
+    'the following arguments are required: --location/-l',
+    'The subscription _xxx_ could not be found.',
+    '_share_ is misspelled or not recognized by the system.',
+    'Resource group _rg_ could not be found.',
+]
+
+SEARCH_KEYWORDS = ['create vm', 'web app', 'storage account', 'deploy web app', 'kubernetes cluster', 'scale server',
+                   'scle server', 'cosmosdb create', 'key vault secret', 'container registry', 'sql database firewall']
+
+ARGUMENTS = ['--name', '--resource-group', '--location', '--sku', '--image', '--plan', '--runtime', '--tags']
+
+
+def get_all_commands():
+    commands = set(COMMAND_TRANSITIONS)
+    for next_commands in COMMAND_TRANSITIONS.values():
+        commands.update(next_commands)
+    return sorted(commands)
+
+
+class WorkloadGenerator:
+
+    def __init__(self, seed=0, max_history=10, error_ratio=0.1):
+        self.random = random.Random(seed)
+        self.max_history = max_history
+        self.error_ratio = error_ratio
+        self.commands = get_all_commands()
+
+    def _next_command(self, command):
+        next_commands = COMMAND_TRANSITIONS.get(command)
+        if not next_commands or self.random.random() < 0.2:
+            return self.random.choice(list(COMMAND_TRANSITIONS))
+        # The earlier commands are more popular
+        return next_commands[min(int(self.random.expovariate(0.6)), len(next_commands) - 1)]
+
+    def generate_command_list(self):
+        length = self.random.randint(1, self.max_history)
+        command = 'group create'
+        command_items = []
+        for _ in range(length):
+            arguments = self.random.sample(ARGUMENTS, self.random.randint(0, 4))
+            command_items.append(json.dumps({'command': command, 'arguments': arguments}))
+            command = self._next_command(command)
+        return json.dumps(command_items)
+
+    def generate_recommendation_request(self):
+        request = {
+            'command_list': self.generate_command_list(),
+            'type': 1,
+            'top_num': 5,
+            'user_id': 'user{}'.format(self.random.randint(0, 100)),
+        }
+        if self.random.random() < self.error_ratio:
+            request['error_info'] = self.random.choice(ERROR_MESSAGES)
+        return request
+
+    def generate_search_request(self):
+        return {
+            'keyword': self.random.choice(SEARCH_KEYWORDS),
+            'top_num': 5,
+        }